@@ -0,0 +1,388 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# aioprotocol.py - Asyncio-based Bitcoin protocol access for Bitnodes.
+#
+# Copyright (c) Addy Yeow Chin Heng <ayeowch@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Asyncio-based Bitcoin protocol access for Bitnodes.
+
+Implements the operations of protocol.Connection as an asyncio protocol
+using the same Serializer, without monkey-patching the standard library.
+Operations that expect a reply from the node return a future for the reply
+messages. Runs on trollius (asyncio backport) on Python 2.
+"""
+
+try:
+    import asyncio
+except ImportError:
+    import trollius as asyncio
+
+import random
+import socket
+import sys
+from operator import itemgetter
+
+from protocol import (ProtocolError, ConnectionError, HeaderTooShortError,
+                      PayloadTooShortError, ProxyRequired,
+                      RemoteHostClosedConnection, Serializer, DEFAULT_PORT,
+                      SOCKET_TIMEOUT)
+
+
+def chain(future, func, loop):
+    """
+    Returns a future that is resolved with func(result) once the specified
+    future is resolved, or with its exception if it has failed.
+    """
+    chained = asyncio.Future(loop=loop)
+
+    def done(future):
+        if future.exception() is not None:
+            chained.set_exception(future.exception())
+        else:
+            chained.set_result(func(future.result()))
+
+    future.add_done_callback(done)
+    return chained
+
+
+class Connection(asyncio.Protocol):
+    """
+    Implements protocol.Connection operations over an asyncio transport.
+    """
+    def __init__(self, to_addr, from_addr=("0.0.0.0", 0), loop=None,
+                 **config):
+        if to_addr[1] == 0:
+            to_addr = (to_addr[0], DEFAULT_PORT)
+        self.to_addr = to_addr
+        self.from_addr = from_addr
+        self.serializer = Serializer(**config)
+        if self.serializer.decode_commands is not None:
+            # Nonce from ping is required to respond with pong
+            self.serializer.decode_commands.add("ping")
+        self.socket_timeout = config.get('socket_timeout', SOCKET_TIMEOUT)
+        self.loop = loop or asyncio.get_event_loop()
+        self.transport = None
+
+        # Received data that is yet to be deserialized into messages
+        self.recv_buffer = bytearray()
+        self.bytes_received = 0
+
+        # Callables that are passed each received message
+        self.handlers = []
+
+    def open(self):
+        """
+        Returns a future that is resolved once the connection is established.
+        Socket is created and connected here to skip the getaddrinfo() calls
+        in a thread pool by loop.create_connection() for host and local_addr
+        as both are expected to be IP addresses.
+        """
+        if self.to_addr[0].endswith(".onion"):
+            raise ProxyRequired(
+                "tor proxy is not supported for asyncio connection")
+        family = socket.AF_INET
+        source_address = self.from_addr
+        if ":" in self.to_addr[0]:
+            family = socket.AF_INET6
+            if ":" not in source_address[0]:
+                source_address = None
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        future = asyncio.Future(loop=self.loop)
+
+        def transport_done(transport):
+            if transport.exception() is not None:
+                sock.close()
+                future.set_exception(transport.exception())
+            else:
+                future.set_result(self)
+
+        def connect_done(connect):
+            if connect.exception() is not None:
+                sock.close()
+                future.set_exception(connect.exception())
+                return
+            asyncio.ensure_future(
+                self.loop.create_connection(lambda: self, sock=sock),
+                loop=self.loop).add_done_callback(transport_done)
+
+        try:
+            if source_address is not None:
+                sock.bind(source_address)
+        except socket.error:
+            sock.close()
+            raise
+        connect = self.loop.sock_connect(sock, self.to_addr)
+        asyncio.ensure_future(
+            asyncio.wait_for(connect, self.socket_timeout, loop=self.loop),
+            loop=self.loop).add_done_callback(connect_done)
+        return future
+
+    def close(self):
+        if self.transport:
+            self.transport.close()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        err = RemoteHostClosedConnection(
+            "{} closed connection".format(self.to_addr))
+        for handler in self.handlers[:]:
+            handler(err)
+
+    def data_received(self, data):
+        self.recv_buffer.extend(data)
+        self.bytes_received += len(data)
+        offset = 0
+        msgs = []
+        try:
+            while offset < len(self.recv_buffer):
+                (msg, offset) = self.serializer.deserialize_msg_from(
+                    self.recv_buffer, offset)
+                msgs.append(msg)
+        except (HeaderTooShortError, PayloadTooShortError):
+            pass  # wait for more data
+        except ProtocolError as err:
+            msgs.append(err)
+        if offset == len(self.recv_buffer):
+            self.recv_buffer = bytearray()  # release memory once drained
+        else:
+            del self.recv_buffer[:offset]
+
+        for msg in msgs:
+            if not isinstance(msg, ProtocolError) and \
+                    msg.get('command') == "ping":
+                self.pong(msg['nonce'])  # respond to ping immediately
+            for handler in self.handlers[:]:
+                handler(msg)
+            if isinstance(msg, ProtocolError):
+                self.transport.close()
+
+    def send(self, data):
+        self.transport.write(data)
+
+    def expect(self, commands, timeout=None, all_commands=True):
+        """
+        Returns a future that is resolved with the received messages once at
+        least one message for each of the specified commands is received, or
+        for any of them if all_commands is False.
+        """
+        future = asyncio.Future(loop=self.loop)
+        msgs = []
+        pending = set(commands)
+
+        def handler(msg):
+            if isinstance(msg, Exception):
+                finish(err=msg)
+            elif msg.get('command') in commands:
+                msgs.append(msg)
+                pending.discard(msg['command'])
+                if len(pending) == 0 or not all_commands:
+                    finish()
+
+        def finish(err=None):
+            timer.cancel()
+            if handler in self.handlers:
+                self.handlers.remove(handler)
+            if future.done():
+                return
+            if err is not None:
+                future.set_exception(err)
+            else:
+                future.set_result(msgs)
+
+        if timeout is None:
+            timeout = self.socket_timeout
+        timer = self.loop.call_later(
+            timeout, finish, socket.timeout("timed out"))
+        self.handlers.append(handler)
+        return future
+
+    def handshake(self):
+        # [version] >>>
+        msg = self.serializer.serialize_msg(
+            command="version", to_addr=self.to_addr, from_addr=self.from_addr)
+        self.send(msg)
+
+        # <<< [version] [verack]
+        return chain(self.expect(["version", "verack"]),
+                     lambda msgs: sorted(msgs, key=itemgetter('command'),
+                                         reverse=True),
+                     self.loop)
+
+    def handshake_getaddr(self, timeout=None, max_addr=None, idle_timeout=0):
+        # [version] >>>
+        msg = self.serializer.serialize_msg(
+            command="version", to_addr=self.to_addr, from_addr=self.from_addr)
+        self.send(msg)
+
+        # <<< [version] [verack] [addr]..
+        def sort_handshake_msgs(reply):
+            (handshake_msgs, addr_msgs) = reply
+            handshake_msgs[:] = sorted(
+                handshake_msgs, key=itemgetter('command'), reverse=True)
+            return (handshake_msgs, addr_msgs)
+
+        return chain(self.recv_addr_msgs(timeout=timeout, max_addr=max_addr,
+                                         idle_timeout=idle_timeout),
+                     sort_handshake_msgs, self.loop)
+
+    def getaddr(self, timeout=None, max_addr=None, idle_timeout=0):
+        # [getaddr] >>>
+        msg = self.serializer.cached_msg(command="getaddr")
+        self.send(msg)
+
+        # <<< [addr]..
+        return chain(self.recv_addr_msgs(timeout=timeout, max_addr=max_addr,
+                                         idle_timeout=idle_timeout),
+                     itemgetter(1), self.loop)
+
+    def recv_addr_msgs(self, timeout=None, max_addr=None, idle_timeout=0):
+        """
+        Returns a future that is resolved with handshake and addr messages
+        using the same limits as protocol.Connection.recv_addr_msgs().
+        """
+        if timeout is None:
+            timeout = self.socket_timeout
+        future = asyncio.Future(loop=self.loop)
+        handshake_msgs = []
+        addr_msgs = []
+        state = {
+            'addr_count': 0,
+            'idle_timer': None,
+        }
+
+        def handler(msg):
+            if isinstance(msg, Exception):
+                finish(err=msg)
+                return
+            if state['idle_timer'] is not None:
+                state['idle_timer'].cancel()
+                state['idle_timer'] = None
+            command = msg.get('command')
+            if command == "version":
+                # [verack] [getaddr] >>>
+                self.send(
+                    self.serializer.cached_msg(command="verack") +
+                    self.serializer.cached_msg(command="getaddr"))
+            if command == "version" or command == "verack":
+                handshake_msgs.append(msg)
+            elif command == "addr":
+                addr_msgs.append(msg)
+                state['addr_count'] += msg['count']
+            if max_addr is not None and state['addr_count'] >= max_addr:
+                finish()
+            elif len(addr_msgs) > 0:
+                state['idle_timer'] = self.loop.call_later(
+                    idle_timeout, finish)
+
+        def finish(err=None):
+            timer.cancel()
+            if state['idle_timer'] is not None:
+                state['idle_timer'].cancel()
+            if handler in self.handlers:
+                self.handlers.remove(handler)
+            if future.done():
+                return
+            if err is not None:
+                future.set_exception(err)
+            else:
+                future.set_result((handshake_msgs, addr_msgs))
+
+        timer = self.loop.call_later(timeout, finish)
+        self.handlers.append(handler)
+        return future
+
+    def addr(self, addr_list):
+        # addr_list = [(TIMESTAMP, SERVICES, "IP_ADDRESS", PORT),]
+        # [addr] >>>
+        msg = self.serializer.serialize_msg(
+            command="addr", addr_list=addr_list)
+        self.send(msg)
+
+    def ping(self, nonce=None):
+        if nonce is None:
+            nonce = random.getrandbits(64)
+
+        # [ping] >>>
+        msg = self.serializer.serialize_msg(command="ping", nonce=nonce)
+        self.send(msg)
+
+    def pong(self, nonce):
+        # [pong] >>>
+        msg = self.serializer.serialize_msg(command="pong", nonce=nonce)
+        self.send(msg)
+
+    def inv(self, inventory):
+        # inventory = [(INV_TYPE, "INV_HASH"),]
+        # [inv] >>>
+        msg = self.serializer.serialize_msg(
+            command="inv", inventory=inventory)
+        self.send(msg)
+
+    def getdata(self, inventory):
+        # inventory = [(INV_TYPE, "INV_HASH"),]
+        # [getdata] >>>
+        msg = self.serializer.serialize_msg(
+            command="getdata", inventory=inventory)
+        self.send(msg)
+
+        # <<< [tx] [block]..
+        return self.expect(["tx", "block"], all_commands=False)
+
+
+def main():
+    to_addr = ("148.251.238.178", 8333)
+    loop = asyncio.get_event_loop()
+
+    handshake_msgs = []
+    addr_msgs = []
+
+    conn = Connection(to_addr, loop=loop)
+    try:
+        print("open")
+        loop.run_until_complete(conn.open())
+
+        print("handshake")
+        handshake_msgs = loop.run_until_complete(conn.handshake())
+
+        print("getaddr")
+        addr_msgs = loop.run_until_complete(conn.getaddr())
+
+    except (ProtocolError, ConnectionError, socket.error,
+            asyncio.TimeoutError) as err:
+        print("{}: {}".format(err, to_addr))
+
+    print("close")
+    conn.close()
+
+    print(handshake_msgs)
+    print(addr_msgs)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,503 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# benchmark.py - Benchmarks for Bitnodes protocol access.
+#
+# Copyright (c) Addy Yeow Chin Heng <ayeowch@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Benchmarks for Bitnodes protocol access.
+
+Benchmarks:
+serializer - every serialize_*/deserialize_* method of protocol.Serializer
+             on fixed corpora; results can be saved as JSON and compared
+             against the saved results from another revision
+tx_hash    - raw vs. re-serialized tx hashing in deserialize_tx_payload
+codec      - codec vs. str(tuple) and eval() for 100k nodes, including
+             Redis memory usage if Redis is available at REDIS_SOCKET
+"""
+
+import binascii
+import gc
+import json
+import os
+import platform
+import random
+import socket
+import struct
+import subprocess
+import sys
+import time
+from collections import OrderedDict
+from cStringIO import StringIO
+
+from codec import NODE, OPEN_NODE
+from protocol import Serializer, sha256
+
+BLOCK_SIZE = 1000000  # bytes
+CODEC_NODES = 100000
+MIN_TIME = 0.2  # seconds spent on each run of a serializer benchmark
+
+# Timestamp in corpora so that their bytes are identical across runs
+CORPUS_TIMESTAMP = 1500000000
+
+
+def get_tx(serializer, tx_in_count=2, tx_out_count=2):
+    """
+    Returns a serialized synthetic tx with the specified number of inputs and
+    outputs using typical P2PKH script sizes.
+    """
+    tx = {
+        'version': 1,
+        'tx_in_count': tx_in_count,
+        'tx_in': [],
+        'tx_out_count': tx_out_count,
+        'tx_out': [],
+        'lock_time': 0,
+    }
+    for _ in xrange(tx_in_count):
+        script = "".join([chr(random.getrandbits(8)) for _ in xrange(107)])
+        tx['tx_in'].append({
+            'prev_out_hash': binascii.hexlify(sha256(script)),
+            'prev_out_index': random.randint(0, 3),
+            'script_length': len(script),
+            'script': script,
+            'sequence': 0xFFFFFFFF,
+        })
+    for _ in xrange(tx_out_count):
+        pubkey_hash = sha256(str(random.random()))[:20]
+        script = "\x76\xA9\x14" + pubkey_hash + "\x88\xAC"
+        tx['tx_out'].append({
+            'value': random.randint(1, 2100000000000000),
+            'script_length': len(script),
+            'script': script,
+        })
+    return serializer.serialize_tx_payload(tx)
+
+
+def get_block(serializer, size=BLOCK_SIZE):
+    """
+    Returns a serialized synthetic block payload of approximately the
+    specified size in bytes.
+    """
+    header = [
+        struct.pack("<I", 2),
+        sha256("prev_block_hash"),
+        sha256("merkle_root"),
+        struct.pack("<I", CORPUS_TIMESTAMP),
+        struct.pack("<I", 0x18172EC0),
+        struct.pack("<I", random.getrandbits(32)),
+    ]
+    txs = []
+    txs_len = 0
+    while txs_len < size - 80:
+        tx = get_tx(serializer)
+        txs.append(tx)
+        txs_len += len(tx)
+    payload = "".join(header + [serializer.serialize_int(len(txs))] + txs)
+    return payload
+
+
+def timeit(func, *args):
+    """
+    Returns the best elapsed time in seconds from several runs of func.
+    """
+    elapsed = []
+    for _ in xrange(5):
+        start = time.time()
+        func(*args)
+        elapsed.append(time.time() - start)
+    return min(elapsed)
+
+
+def rate(func, args, min_time=MIN_TIME):
+    """
+    Returns the best calls per second of func(*args) from several runs of
+    at least min_time seconds each.
+    """
+    number = 1
+    while True:
+        start = time.time()
+        for _ in xrange(number):
+            func(*args)
+        elapsed = time.time() - start
+        if elapsed >= min_time:
+            break
+        number *= 2 if elapsed == 0 else max(2, int(min_time / elapsed) + 1)
+    best = elapsed
+    for _ in xrange(2):
+        start = time.time()
+        for _ in xrange(number):
+            func(*args)
+        best = min(best, time.time() - start)
+    return number / best
+
+
+def count_allocs(func, args):
+    """
+    Returns the number of objects tracked by the garbage collector, e.g.
+    dicts, lists and records, that are allocated by func(*args) and still
+    alive when it returns, which includes the objects in its result.
+    """
+    def measure(func, args):
+        gc.collect()
+        gc.disable()
+        try:
+            before = gc.get_count()[0]
+            result = func(*args)
+            allocs = gc.get_count()[0] - before
+        finally:
+            gc.enable()
+        del result
+        return allocs
+
+    # Exclude objects allocated by the measurement itself
+    return measure(func, args) - measure(lambda *args: None, args)
+
+
+def get_corpora(serializer):
+    """
+    Returns the fixed corpora for the serializer benchmarks as name -> (
+    command, payload, serialize_msg() kwargs or None if the command is not
+    supported by serialize_msg()).
+    """
+    now = CORPUS_TIMESTAMP
+    to_addr = ("127.0.0.1", 8333)
+    from_addr = ("0.0.0.0", 0)
+    addr_list = [
+        (now, 1, socket.inet_ntoa(struct.pack(">I", random.getrandbits(32))),
+         8333)
+        for _ in xrange(1000)
+    ]
+    inventory = [
+        (1, binascii.hexlify(sha256(str(idx))))
+        for idx in xrange(50000)
+    ]
+    corpora = OrderedDict()
+    version_payload = serializer.serialize_version_payload(
+        (serializer.to_services,) + to_addr,
+        (serializer.from_services,) + from_addr)
+    # version (4 bytes), services (8 bytes), timestamp (8 bytes)
+    version_payload = (version_payload[:12] +
+                       struct.pack("<q", CORPUS_TIMESTAMP) +
+                       version_payload[20:])
+    corpora['version'] = (
+        "version",
+        version_payload,
+        {'to_addr': to_addr, 'from_addr': from_addr})
+    corpora['addr_1000'] = (
+        "addr",
+        serializer.serialize_addr_payload(addr_list),
+        {'addr_list': addr_list})
+    corpora['inv_50000'] = (
+        "inv",
+        serializer.serialize_inv_payload(inventory),
+        {'inventory': inventory})
+    corpora['tx'] = ("tx", get_tx(serializer), None)
+    corpora['tx_large'] = (
+        "tx", get_tx(serializer, tx_in_count=100, tx_out_count=100), None)
+    corpora['block'] = ("block", get_block(serializer), None)
+    return corpora
+
+
+def get_serializer_cases(serializer):
+    """
+    Returns the serializer benchmarks as name -> (func, args, bytes) where
+    bytes is the size of the encoded data that func encodes or decodes.
+    Methods that decode from a stream are passed a new StringIO in each call.
+    """
+    corpora = get_corpora(serializer)
+    cases = OrderedDict()
+
+    def from_stream(func, *args):
+        return lambda data: func(StringIO(data), *args)
+
+    for (name, (command, payload, kwargs)) in corpora.items():
+        msg = serializer.frame_msg(command, payload)
+        if kwargs is not None:
+            kwargs = dict(kwargs, command=command)
+            cases["serialize_msg:" + name] = (
+                lambda kwargs: serializer.serialize_msg(**kwargs),
+                (kwargs,), len(msg))
+        cases["frame_msg:" + name] = (
+            serializer.frame_msg, (command, payload), len(msg))
+        cases["deserialize_msg:" + name] = (
+            serializer.deserialize_msg, (msg,), len(msg))
+        cases["deserialize_msg_from:" + name] = (
+            serializer.deserialize_msg_from, (msg,), len(msg))
+        cases["deserialize_header:" + name] = (
+            serializer.deserialize_header, (msg,), 24)
+        cases["deserialize_payload:" + name] = (
+            serializer.deserialize_payload, (command, payload), len(payload))
+
+    (_, payload, kwargs) = corpora['version']
+    cases["serialize_version_payload:version"] = (
+        serializer.serialize_version_payload,
+        ((serializer.to_services,) + kwargs['to_addr'],
+         (serializer.from_services,) + kwargs['from_addr']),
+        len(payload))
+    cases["deserialize_version_payload:version"] = (
+        serializer.deserialize_version_payload, (payload,), len(payload))
+
+    ping = serializer.serialize_ping_payload(random.getrandbits(64))
+    cases["serialize_ping_payload:ping"] = (
+        serializer.serialize_ping_payload, (random.getrandbits(64),),
+        len(ping))
+    cases["deserialize_ping_payload:ping"] = (
+        serializer.deserialize_ping_payload, (ping,), len(ping))
+
+    (_, payload, kwargs) = corpora['addr_1000']
+    cases["serialize_addr_payload:addr_1000"] = (
+        serializer.serialize_addr_payload, (kwargs['addr_list'],),
+        len(payload))
+    cases["deserialize_addr_payload:addr_1000"] = (
+        serializer.deserialize_addr_payload, (payload,), len(payload))
+
+    (_, payload, kwargs) = corpora['inv_50000']
+    cases["serialize_inv_payload:inv_50000"] = (
+        serializer.serialize_inv_payload, (kwargs['inventory'],),
+        len(payload))
+    cases["deserialize_inv_payload:inv_50000"] = (
+        serializer.deserialize_inv_payload, (payload,), len(payload))
+
+    for name in ("tx", "tx_large"):
+        payload = corpora[name][1]
+        tx = serializer.deserialize_tx_payload(payload)
+        cases["serialize_tx_payload:" + name] = (
+            serializer.serialize_tx_payload, (tx,), len(payload))
+        cases["deserialize_tx_payload:" + name] = (
+            serializer.deserialize_tx_payload, (payload,), len(payload))
+
+    payload = corpora['block'][1]
+    cases["deserialize_block_payload:block"] = (
+        serializer.deserialize_block_payload, (payload,), len(payload))
+
+    tx = serializer.deserialize_tx_payload(corpora['tx'][1])
+    addr = corpora['addr_1000'][2]['addr_list'][0]
+    inventory = corpora['inv_50000'][2]['inventory'][0]
+    components = [
+        ("network_address", addr,
+         from_stream(serializer.deserialize_network_address, True)),
+        ("inventory", inventory,
+         from_stream(serializer.deserialize_inventory)),
+        ("tx_in", tx['tx_in'][0], from_stream(serializer.deserialize_tx_in)),
+        ("tx_out", tx['tx_out'][0],
+         from_stream(serializer.deserialize_tx_out)),
+        ("string", serializer.user_agent,
+         from_stream(serializer.deserialize_string)),
+        ("int", 0xFFFF, from_stream(serializer.deserialize_int)),
+    ]
+    for (name, value, deserialize) in components:
+        data = getattr(serializer, "serialize_" + name)(value)
+        cases["serialize_{}".format(name)] = (
+            getattr(serializer, "serialize_" + name), (value,), len(data))
+        cases["deserialize_{}".format(name)] = (deserialize, (data,),
+                                                len(data))
+
+    return cases
+
+
+def get_revision():
+    """
+    Returns the git revision of the working tree or None if unavailable.
+    """
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(
+                ["git", "rev-parse", "--short", "HEAD"],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_serializer(output=None, baseline=None):
+    """
+    Measures ops/sec, bytes/sec and allocations per call of every
+    serialize_*/deserialize_* method of Serializer, optionally saving the
+    results as JSON in output and comparing them against the results saved
+    in baseline.
+    """
+    serializer = Serializer()
+    cases = get_serializer_cases(serializer)
+
+    # Every serialize_*/deserialize_* method must have a benchmark
+    methods = set([name for name in dir(serializer)
+                   if name.startswith(("serialize_", "deserialize_"))])
+    covered = set([name.split(":")[0] for name in cases.keys()])
+    missing = methods - covered
+    assert len(missing) == 0, "missing benchmarks: {}".format(
+        ", ".join(sorted(missing)))
+
+    base = {}
+    if baseline is not None:
+        base = json.load(open(baseline))['results']
+
+    print("{:<44}{:>12}{:>10}{:>10}{:>10}".format(
+        "", "ops/sec", "MB/sec", "allocs", "vs base"))
+    results = OrderedDict()
+    for (name, (func, args, size)) in cases.items():
+        ops = rate(func, args)
+        results[name] = {
+            'ops_per_sec': ops,
+            'bytes_per_sec': ops * size,
+            'allocs_per_op': count_allocs(func, args),
+            'bytes': size,
+        }
+        ratio = ""
+        if name in base:
+            ratio = "{:.2f}x".format(ops / base[name]['ops_per_sec'])
+        print("{:<44}{:>12.1f}{:>10.1f}{:>10d}{:>10}".format(
+            name, ops, ops * size / 1e6, results[name]['allocs_per_op'],
+            ratio))
+
+    if output is not None:
+        report = {
+            'revision': get_revision(),
+            'python': platform.python_version(),
+            'timestamp': int(time.time()),
+            'results': results,
+        }
+        with open(output, 'w') as out:
+            json.dump(report, out, indent=2)
+        print("Results saved in {}".format(output))
+
+
+def bench_tx_hash():
+    """
+    Compares deserialize_tx_payload() hashing the raw tx bytes in a block
+    against the previous approach of re-serializing each tx to hash it.
+    """
+    serializer = Serializer()
+    payload = get_block(serializer)
+
+    def get_txs(payload, raw):
+        data = StringIO(payload)
+        data.seek(80)
+        tx_count = serializer.deserialize_int(data)
+        if raw:
+            return [serializer.deserialize_tx_payload(data, payload=payload)
+                    for _ in xrange(tx_count)]
+        # Without payload, tx hash is calculated from the re-serialized tx
+        return [serializer.deserialize_tx_payload(data)
+                for _ in xrange(tx_count)]
+
+    txs = get_txs(payload, raw=True)
+    assert txs == get_txs(payload, raw=False)
+    assert txs == serializer.deserialize_block_payload(payload)['tx']
+
+    print("block: {} bytes, {} txs".format(len(payload), len(txs)))
+    old = timeit(get_txs, payload, False)
+    new = timeit(get_txs, payload, True)
+    print("re-serialized tx hash: {:.3f}s".format(old))
+    print("raw tx hash: {:.3f}s ({:.2f}x)".format(new, old / new))
+
+
+def get_redis_memory(key, values):
+    """
+    Returns the Redis memory usage in bytes of a set with the specified
+    values or None if Redis is not available.
+    """
+    import redis
+    redis_conn = redis.StrictRedis(
+        unix_socket_path=os.environ.get('REDIS_SOCKET', "/tmp/redis.sock"),
+        password=os.environ.get('REDIS_PASSWORD', None))
+    try:
+        redis_conn.delete(key)
+        before = redis_conn.info('memory')['used_memory']
+        redis_pipe = redis_conn.pipeline()
+        for idx in xrange(0, len(values), 1000):
+            redis_pipe.sadd(key, *values[idx:idx + 1000])
+        redis_pipe.execute()
+        used_memory = redis_conn.info('memory')['used_memory'] - before
+        redis_conn.delete(key)
+    except redis.ConnectionError:
+        return None
+    return used_memory
+
+
+def bench_codec():
+    """
+    Compares encoding and decoding of nodes stored in Redis using codec
+    against the previous str(tuple) and eval() approach.
+    """
+    now = CORPUS_TIMESTAMP
+    nodes = []
+    open_nodes = []
+    for idx in xrange(CODEC_NODES):
+        if idx % 10 == 0:
+            address = socket.inet_ntop(socket.AF_INET6, sha256(str(idx))[:16])
+        else:
+            address = socket.inet_ntoa(struct.pack(">I",
+                                                   random.getrandbits(32)))
+        nodes.append((address, 8333, 1))
+        open_nodes.append((address, 8333, 70002, "/Satoshi:0.10.0/",
+                           now - random.randint(0, 86400), 1))
+
+    def encode_all(encode, nodes):
+        return [encode(node) for node in nodes]
+
+    def decode_all(decode, values):
+        return [decode(value) for value in values]
+
+    print("{:<20}{:>10}{:>12}{:>12}{:>14}".format(
+        "", "format", "encode (s)", "decode (s)", "size (bytes)"))
+    for (name, codec, tuples) in (("pending", NODE, nodes),
+                                  ("opendata", OPEN_NODE, open_nodes)):
+        for (fmt, encode, decode) in (("repr", str, eval),
+                                      ("codec", codec.encode, codec.decode)):
+            values = encode_all(encode, tuples)
+            assert decode_all(decode, values) == tuples
+            encode_time = timeit(encode_all, encode, tuples)
+            decode_time = timeit(decode_all, decode, values)
+            size = sum([len(value) for value in values])
+            print("{:<20}{:>10}{:>12.3f}{:>12.3f}{:>14d}".format(
+                name, fmt, encode_time, decode_time, size))
+            used_memory = get_redis_memory("benchmark:codec", values)
+            if used_memory is not None:
+                print("{:<20}{:>10}{:>38d}".format(
+                    "", "redis", used_memory))
+
+
+def main(argv):
+    if len(argv) > 1 and argv[1] not in ("serializer", "tx_hash", "codec"):
+        print("Usage: benchmark.py [serializer [output] [baseline]|tx_hash|"
+              "codec]")
+        return 1
+
+    # Corpora are generated from a fixed seed to be identical in every run
+    random.seed(0)
+
+    if len(argv) > 1 and argv[1] == "tx_hash":
+        bench_tx_hash()
+    elif len(argv) > 1 and argv[1] == "codec":
+        bench_codec()
+    else:
+        output = argv[2] if len(argv) > 2 else None
+        baseline = argv[3] if len(argv) > 3 else None
+        bench_serializer(output=output, baseline=baseline)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# codec.py - Compact binary encoding of node tuples stored in Redis.
+#
+# Copyright (c) Addy Yeow Chin Heng <ayeowch@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Compact binary encoding of node tuples stored in Redis.
+
+Each tuple is encoded as a format byte followed by its fixed-width fields
+packed with a precompiled struct and its variable-length strings. The
+format byte selects a 4-byte or 16-byte layout for the address and never
+starts a tuple repr so values written in the previous str(tuple) format
+are still decoded, without eval(), during migration.
+"""
+
+import socket
+import struct
+from ast import literal_eval
+from base64 import b32decode, b32encode
+
+from protocol import ONION_PREFIX
+
+# First byte of encoded values
+IPV4_FORMAT = "\x01"  # also used for tuples without address
+IPV6_FORMAT = "\x02"  # ipv6 or .onion address
+
+# Field types in addition to struct format characters
+ADDRESS = "A"  # ipv4, ipv6 or .onion address, at most one per tuple
+STRING = "S"  # unicode or None with 2-byte length prefix, stored in UTF-8
+NONE_LEN = 0xFFFF  # length prefix for None
+
+STRING_LEN = struct.Struct("<H")
+
+
+class DecodeError(Exception):
+    pass
+
+
+def pack_address(address):
+    """
+    Returns the format byte and the 4-byte ipv4 address or 16-byte raw IP
+    address for the specified address.
+    """
+    if ":" in address:
+        return (IPV6_FORMAT, socket.inet_pton(socket.AF_INET6, address))
+    elif address.endswith(".onion"):
+        return (IPV6_FORMAT, ONION_PREFIX + b32decode(address[:-6], True))
+    return (IPV4_FORMAT, socket.inet_pton(socket.AF_INET, address))
+
+
+def unpack_address(raw_ip):
+    """
+    Returns the address for the specified 4-byte ipv4 address or 16-byte raw
+    IP address.
+    """
+    if len(raw_ip) == 4:
+        return socket.inet_ntop(socket.AF_INET, raw_ip)
+    elif raw_ip[:6] == ONION_PREFIX:
+        return b32encode(raw_ip[6:]).lower() + ".onion"
+    return socket.inet_ntop(socket.AF_INET6, raw_ip)
+
+
+class Codec(object):
+    """
+    Encodes and decodes tuples with the specified field types, e.g. "AHQ"
+    for (address, port, services). Fixed-width fields are packed together
+    in one struct followed by the strings in their order in the tuple.
+    """
+    def __init__(self, fields):
+        self.fields = fields
+        self.fixed = [idx for (idx, field) in enumerate(fields)
+                      if field != STRING]
+        self.strings = [idx for (idx, field) in enumerate(fields)
+                        if field == STRING]
+        self.address = None  # position of address within fixed fields
+        if ADDRESS in fields:
+            self.address = self.fixed.index(fields.index(ADDRESS))
+        fmt = "<" + "".join([fields[idx] for idx in self.fixed])
+        self.structs = {
+            IPV4_FORMAT: struct.Struct(fmt.replace(ADDRESS, "4s")),
+            IPV6_FORMAT: struct.Struct(fmt.replace(ADDRESS, "16s")),
+        }
+
+    def encode(self, node):
+        """
+        Returns the encoded string for the specified tuple.
+        """
+        values = [node[idx] for idx in self.fixed]
+        fmt = IPV4_FORMAT
+        if self.address is not None:
+            (fmt, values[self.address]) = pack_address(values[self.address])
+        if not self.strings:
+            return fmt + self.structs[fmt].pack(*values)
+        data = [fmt, self.structs[fmt].pack(*values)]
+        for idx in self.strings:
+            value = node[idx]
+            if value is None:
+                data.append(STRING_LEN.pack(NONE_LEN))
+                continue
+            if isinstance(value, unicode):
+                value = value.encode("utf-8")
+            data.append(STRING_LEN.pack(len(value)))
+            data.append(value)
+        return "".join(data)
+
+    def decode(self, data):
+        """
+        Returns the tuple for the specified encoded string or for a string in
+        the previous str(tuple) format. Strings are decoded into unicode.
+        """
+        fmt = self.structs.get(data[:1])
+        if fmt is None:
+            return decode_legacy(data)
+        try:
+            values = fmt.unpack_from(data, 1)
+        except struct.error as err:
+            raise DecodeError(err)
+        node = [None] * len(self.fields)
+        for (idx, value) in zip(self.fixed, values):
+            node[idx] = value
+        if self.address is not None:
+            idx = self.fixed[self.address]
+            node[idx] = unpack_address(node[idx])
+        offset = 1 + fmt.size
+        for idx in self.strings:
+            try:
+                length = STRING_LEN.unpack_from(data, offset)[0]
+            except struct.error as err:
+                raise DecodeError(err)
+            offset += STRING_LEN.size
+            if length == NONE_LEN:
+                continue
+            node[idx] = decode_string(data[offset:offset + length])
+            offset += length
+        return tuple(node)
+
+
+def decode_string(value):
+    """
+    Returns unicode for the specified UTF-8 string. Byte strings that are not
+    valid UTF-8, e.g. user agent from a node, are decoded as latin-1 so that
+    each byte maps to one character as in json.dumps(encoding="latin-1").
+    """
+    try:
+        return value.decode("utf-8")
+    except UnicodeDecodeError:
+        return value.decode("latin-1")
+
+
+def decode_legacy(data):
+    """
+    Returns the tuple for the specified string in the previous str(tuple)
+    format. Only Python literals are evaluated.
+    """
+    try:
+        node = literal_eval(data)
+    except (SyntaxError, ValueError) as err:
+        raise DecodeError("{}: {!r}".format(err, data))
+    if not isinstance(node, tuple):
+        raise DecodeError("not a tuple: {!r}".format(data))
+    return node
+
+
+# Node in pending and check set: address, port, services
+NODE = Codec("AHQ")
+
+# Node in reachable set: address, port, services, height
+REACHABLE_NODE = Codec("AHQi")
+
+# Node in open set: address, port
+OPEN_ADDR = Codec("AH")
+
+# Node in opendata set: address, port, version, user_agent, timestamp,
+# services
+OPEN_NODE = Codec("AHiSIQ")
+
+# GeoIP data in resolve:ADDRESS hash: city, country, latitude, longitude,
+# timezone, asn, org
+GEOIP = Codec("SSddSSS")
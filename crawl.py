@@ -32,21 +32,25 @@ from gevent import monkey
 monkey.patch_all()
 
 import gevent
-import json
+import gevent.queue
 import logging
 import os
 import redis
 import redis.connection
 import socket
+import struct
 import sys
 import time
-from binascii import hexlify
+from bisect import bisect_right
 from collections import Counter
 from ConfigParser import ConfigParser
 from ipaddress import ip_network
 
+from codec import NODE
 from protocol import (ProtocolError, ConnectionError, Connection, SERVICES,
-                      DEFAULT_PORT)
+                      DEFAULT_PORT, IPV4_PREFIX, ONION_PREFIX)
+from snapshot import Writer
+from supervisor import STATUS, Supervisor, get_processes, report_status
 
 redis.connection.socket = gevent.socket
 
@@ -58,6 +62,94 @@ REDIS_CONN = redis.StrictRedis(unix_socket_path=REDIS_SOCKET,
 
 SETTINGS = {}
 
+# Max. commands or keys in each Redis pipeline or batch read
+REDIS_BATCH_SIZE = 1000
+
+IPV4_ADDRESS = struct.Struct(">I")
+IPV6_ADDRESS = struct.Struct(">QQ")
+
+# Column types of rows in snapshot sidecar: address, port, services, height
+SNAPSHOT_FIELDS = "SHQi"
+
+# Sets state for nodes in the round that is current when the script runs so
+# that states are never written into a round that restart() has already
+# read. Returns the round ID followed by the result of each HSETNX or HSET.
+# KEYS[1] = crawl:round, ARGV = [prefix of round key, command, state, node..]
+SET_STATES = """
+local round_id = redis.call('GET', KEYS[1]) or ''
+local key = ARGV[1] .. round_id
+local result = {round_id}
+for idx = 4, #ARGV do
+    result[#result + 1] = redis.call(ARGV[2], key, ARGV[idx], ARGV[3])
+end
+return result
+"""
+
+
+class NetworkIndex(object):
+    """
+    Prefix-match index of networks stored as sorted, non-overlapping address
+    intervals so that each lookup is a binary search over the interval
+    starts regardless of the number of networks.
+    """
+    def __init__(self, networks):
+        # networks = [(NETWORK_ADDRESS, BROADCAST_ADDRESS),]
+        self.starts = []
+        self.ends = []
+        for (start, end) in sorted(networks):
+            if self.ends and start <= self.ends[-1] + 1:
+                self.ends[-1] = max(self.ends[-1], end)  # merge overlap
+                continue
+            self.starts.append(start)
+            self.ends.append(end)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __contains__(self, addr):
+        idx = bisect_right(self.starts, addr) - 1
+        return idx >= 0 and addr <= self.ends[idx]
+
+
+class PeerFilter(object):
+    """
+    Per-round set of peers already added into the crawl set by this process
+    to skip the redundant SADD for peers advertised by many nodes. The set is
+    cleared once it holds max_peers_filter peers to bound its memory usage.
+    """
+    def __init__(self):
+        self.round = None
+        self.peers = set()
+        self.hits = 0
+        self.misses = 0
+
+    def add(self, peer):
+        """
+        Returns True if peer is new in this round, False if otherwise.
+        """
+        if peer in self.peers:
+            self.hits += 1
+            return False
+        if len(self.peers) >= SETTINGS['max_peers_filter']:
+            self.peers.clear()
+        self.peers.add(peer)
+        self.misses += 1
+        return True
+
+    def reset(self, round_id):
+        """
+        Clears the filter for a new round.
+        """
+        logging.info("Peer filter: %d hits, %d misses", self.hits,
+                     self.misses)
+        self.round = round_id
+        self.peers.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+PEER_FILTER = PeerFilter()
+
 
 def enumerate_node(redis_pipe, addr_msgs, now):
     """
@@ -67,7 +159,8 @@ def enumerate_node(redis_pipe, addr_msgs, now):
 
     for addr_msg in addr_msgs:
         if 'addr_list' in addr_msg:
-            for peer in addr_msg['addr_list']:
+            excluded = get_excluded(addr_msg['addr_list'])
+            for (peer, peer_excluded) in zip(addr_msg['addr_list'], excluded):
                 age = now - peer['timestamp']  # seconds
 
                 # Add peering node with age <= 24 hours into crawl set
@@ -77,33 +170,35 @@ def enumerate_node(redis_pipe, addr_msgs, now):
                     services = peer['services']
                     if not address:
                         continue
-                    if is_excluded(address):
+                    if peer_excluded:
                         logging.debug("Exclude: %s", address)
                         continue
-                    redis_pipe.sadd('pending', (address, port, services))
+                    node = (address, port, services)
+                    if not PEER_FILTER.add(node):
+                        continue
+                    redis_pipe.sadd('pending', NODE.encode(node))
                     peers += 1
 
     return peers
 
 
-def connect(redis_conn, key):
+def connect(redis_conn, node, height):
     """
     Establishes connection with a node to:
     1) Send version message
     2) Receive version and verack message
-    3) Send getaddr message
+    3) Send verack and getaddr message once version message is received
     4) Receive addr message containing list of peering nodes
-    Stores state and height for node in Redis.
+    The exchange is given up to node_timeout seconds to complete. Addr
+    messages are read until max_addr addresses are received or until no
+    message is received for addr_idle_timeout seconds.
+    Stores state and height for node in Redis. State is stored in the
+    current round even if a new round has started since node was claimed.
     """
     handshake_msgs = []
     addr_msgs = []
 
-    redis_conn.hset(key, 'state', "")  # Set Redis hash for a new node
-
-    (address, port, services) = key[5:].split("-", 2)
-    height = redis_conn.get('height')
-    if height:
-        height = int(height)
+    (address, port, services) = node.split("-", 2)
 
     conn = Connection((address, int(port)),
                       (SETTINGS['source_address'], 0),
@@ -113,82 +208,122 @@ def connect(redis_conn, key):
                       from_services=SETTINGS['services'],
                       user_agent=SETTINGS['user_agent'],
                       height=height,
-                      relay=SETTINGS['relay'])
+                      relay=SETTINGS['relay'],
+                      decode_commands=["version", "addr"])
     try:
         logging.debug("Connecting to %s", conn.to_addr)
         conn.open()
-        handshake_msgs = conn.handshake()
-        addr_msgs = conn.getaddr()
+        (handshake_msgs, addr_msgs) = conn.handshake_getaddr(
+            timeout=SETTINGS['node_timeout'],
+            max_addr=SETTINGS['max_addr'],
+            idle_timeout=SETTINGS['addr_idle_timeout'])
     except (ProtocolError, ConnectionError, socket.error) as err:
         logging.debug("%s: %s", conn.to_addr, err)
     finally:
         conn.close()
 
-    gevent.sleep(0.3)
+    logging.debug("%s Addr: %d (%d bytes)", conn.to_addr,
+                  sum([msg['count'] for msg in addr_msgs]),
+                  conn.bytes_received)
+
+    STATUS['nodes'] += 1
     redis_pipe = redis_conn.pipeline()
     if len(handshake_msgs) > 0:
+        STATUS['up'] += 1
         height_key = "height:{}-{}".format(address, port)
         redis_pipe.setex(height_key, SETTINGS['max_age'],
                          handshake_msgs[0].get('height', 0))
         now = int(time.time())
         peers = enumerate_node(redis_pipe, addr_msgs, now)
         logging.debug("%s Peers: %d", conn.to_addr, peers)
-        redis_pipe.hset(key, 'state', "up")
+        if peers > 0:
+            redis_pipe.publish('crawl:pending', peers)  # wake idle workers
+        set_states(redis_pipe, "HSET", "up", [node])
     redis_pipe.execute()
 
 
 def dump(timestamp, nodes):
     """
     Dumps data for reachable nodes into timestamp-prefixed JSON file and
-    returns most common height from the nodes.
+    returns most common height from the nodes. Heights are read in batches
+    and rows are written to a temporary file as they are read, which is
+    renamed into place once complete.
     """
-    json_data = []
-
-    for node in nodes:
-        (address, port, services) = node[5:].split("-", 2)
-        try:
-            height = int(REDIS_CONN.get("height:{}-{}".format(address, port)))
-        except TypeError:
-            logging.warning("height:%s-%s missing", address, port)
-            height = 0
-        json_data.append([address, int(port), int(services), height])
+    heights = Counter()
 
     json_output = os.path.join(SETTINGS['crawl_dir'],
                                "{}.json".format(timestamp))
-    open(json_output, 'w').write(json.dumps(json_data))
+    fields = SNAPSHOT_FIELDS if SETTINGS['sidecar'] else None
+    with Writer(json_output, fields=fields) as writer:
+        for idx in xrange(0, len(nodes), REDIS_BATCH_SIZE):
+            batch = [node.split("-", 2)
+                     for node in nodes[idx:idx + REDIS_BATCH_SIZE]]
+            keys = ["height:{}-{}".format(address, port)
+                    for (address, port, _) in batch]
+            for ((address, port, services), height) in zip(
+                    batch, REDIS_CONN.mget(keys)):
+                if height is None:
+                    logging.warning("height:%s-%s missing", address, port)
+                    height = 0
+                height = int(height)
+                heights[height] += 1
+                writer.write([address, int(port), int(services), height])
     logging.info("Wrote %s", json_output)
 
-    return Counter([node[-1] for node in json_data]).most_common(1)[0][0]
+    return heights.most_common(1)[0][0]
+
+
+def set_states(redis_conn, command, state, nodes):
+    """
+    Sets state for the specified nodes in the current round using HSET or
+    HSETNX as command.
+    """
+    redis_conn.eval(SET_STATES, 1, 'crawl:round', get_round_key(""), command,
+                    state, *nodes)
+
+
+def get_round_key(round_id):
+    """
+    Returns the key of the Redis hash holding the states for all nodes
+    claimed in the specified round.
+    """
+    return "crawl:nodes:{}".format(round_id)
 
 
 def restart(timestamp):
     """
+    Starts a new round with the specified timestamp as its round ID.
     Dumps data for the reachable nodes into a JSON file.
     Loads all reachable nodes from Redis into the crawl set.
-    Removes keys for all nodes from current crawl.
+    Expires states for all nodes from previous round.
     Updates number of reachable nodes and most common height in Redis.
     """
     nodes = []  # Reachable nodes
 
-    keys = REDIS_CONN.keys('node:*')
-    logging.debug("Keys: %d", len(keys))
+    # Workers write states for the nodes they claim from now on into the new
+    # round while the states from the previous round are read here.
+    key = get_round_key(REDIS_CONN.getset('crawl:round', timestamp))
 
     redis_pipe = REDIS_CONN.pipeline()
-    for key in keys:
-        state = REDIS_CONN.hget(key, 'state')
+    for (node, state) in REDIS_CONN.hscan_iter(key, count=REDIS_BATCH_SIZE):
         if state == "up":
-            nodes.append(key)
-            (address, port, services) = key[5:].split("-", 2)
-            redis_pipe.sadd('pending', (address, int(port), int(services)))
-        redis_pipe.delete(key)
+            nodes.append(node)
+            (address, port, services) = node.split("-", 2)
+            redis_pipe.sadd('pending',
+                            NODE.encode((address, int(port), int(services))))
+            if len(redis_pipe) >= REDIS_BATCH_SIZE:
+                redis_pipe.execute()
+    logging.debug("Nodes: %d", len(nodes))
 
     # Reachable nodes from https://getaddr.bitnodes.io/#join-the-network
     checked_nodes = REDIS_CONN.zrangebyscore(
         'check', timestamp - SETTINGS['max_age'], timestamp)
     for node in checked_nodes:
-        (address, port, services) = eval(node)
-        redis_pipe.sadd('pending', (address, port, services))
+        (address, port, services) = NODE.decode(node)
+        redis_pipe.sadd('pending', NODE.encode((address, port, services)))
 
+    redis_pipe.expire(key, SETTINGS['round_ttl'])
+    redis_pipe.publish('crawl:pending', len(nodes))
     redis_pipe.execute()
 
     reachable_nodes = len(nodes)
@@ -227,35 +362,90 @@ def cron():
         gevent.sleep(SETTINGS['cron_delay'])
 
 
-def task():
+def claim(queue):
     """
-    Assigned to a worker to retrieve (pop) a node from the crawl set and
-    attempt to establish connection with a new node.
+    Assigned to a worker to retrieve (pop) nodes from the crawl set in
+    batches and claim the new nodes for the task workers in this process
+    through the local queue as tuples of node and height. Task
+    workers are woken up as soon as a node is queued while this worker
+    blocks once the queue is full, or until nodes are added into the crawl
+    set once it is empty.
     """
     redis_conn = redis.StrictRedis(unix_socket_path=REDIS_SOCKET,
                                    password=REDIS_PASSWORD)
+    pubsub = redis_conn.pubsub()
 
     while True:
-        if not SETTINGS['master']:
-            while REDIS_CONN.get('crawl:master:state') != "running":
-                gevent.sleep(SETTINGS['socket_timeout'])
+        state = REDIS_CONN.get('crawl:master:state')
+        if not SETTINGS['master'] and state != "running":
+            gevent.sleep(SETTINGS['socket_timeout'])
+            continue
 
-        node = redis_conn.spop('pending')  # Pop random node from set
-        if node is None:
-            gevent.sleep(1)
+        # Pop random nodes from set
+        nodes = redis_conn.execute_command('SPOP', 'pending',
+                                           SETTINGS['claim_size'])
+        if not nodes:
+            wait_pending(pubsub, SETTINGS['cron_delay'])
             continue
 
-        node = eval(node)  # Convert string from Redis to tuple
+        new_nodes = []
+        for node in nodes:
+            node = NODE.decode(node)  # Convert string from Redis to tuple
 
-        # Skip IPv6 node
-        if ":" in node[0] and not SETTINGS['ipv6']:
-            continue
+            # Skip IPv6 node
+            if ":" in node[0] and not SETTINGS['ipv6']:
+                continue
 
-        key = "node:{}-{}-{}".format(node[0], node[1], node[2])
-        if redis_conn.exists(key):
-            continue
+            new_nodes.append("{}-{}-{}".format(node[0], node[1], node[2]))
+
+        # Set state for new nodes in the current round; nodes with existing
+        # state have been claimed by another worker in this round.
+        redis_pipe = redis_conn.pipeline()
+        set_states(redis_pipe, "HSETNX", "", new_nodes)
+        redis_pipe.get('height')
+        (result, height) = redis_pipe.execute()
+        if height:
+            height = int(height)
+        round_id = result.pop(0)
+        if round_id != PEER_FILTER.round:
+            PEER_FILTER.reset(round_id)  # master has started a new round
+        claimed = [new_nodes[idx] for (idx, new) in enumerate(result) if new]
+        logging.debug("Claimed: %d of %d", len(claimed), len(nodes))
 
-        connect(redis_conn, key)
+        for node in claimed:
+            queue.put((node, height))
+
+
+def wait_pending(pubsub, timeout):
+    """
+    Blocks until nodes are added into the crawl set or for up to timeout
+    seconds. Worker is subscribed to crawl:pending only while it waits so
+    that the messages are never delivered to busy workers.
+    """
+    pubsub.subscribe('crawl:pending')
+    try:
+        if REDIS_CONN.scard('pending') > 0:  # added before subscribing
+            return
+        with gevent.Timeout(timeout, False):
+            for msg in pubsub.listen():
+                # 'crawl:pending' message is published after adding nodes
+                if msg['type'] == "message":
+                    return
+    finally:
+        pubsub.reset()  # unsubscribe and close connection
+
+
+def task(queue):
+    """
+    Assigned to a worker to retrieve a claimed node from the local queue and
+    attempt to establish connection with the node.
+    """
+    redis_conn = redis.StrictRedis(unix_socket_path=REDIS_SOCKET,
+                                   password=REDIS_PASSWORD)
+
+    while True:
+        (node, height) = queue.get()
+        connect(redis_conn, node, height)
 
 
 def set_pending():
@@ -276,24 +466,65 @@ def set_pending():
                 logging.debug("Exclude: %s", address)
                 continue
             logging.debug("%s: %s", seeder, address)
-            REDIS_CONN.sadd('pending', (address, DEFAULT_PORT, SERVICES))
+            REDIS_CONN.sadd('pending',
+                            NODE.encode((address, DEFAULT_PORT, SERVICES)))
+    REDIS_CONN.publish('crawl:pending', 0)
 
 
 def is_excluded(address):
     """
     Returns True if address is found in exclusion list, False if otherwise.
     """
-    address_family = socket.AF_INET
-    key = 'exclude_ipv4_networks'
-    if ":" in address:
-        address_family = socket.AF_INET6
-        key = 'exclude_ipv6_networks'
     try:
-        addr = int(hexlify(socket.inet_pton(address_family, address)), 16)
+        if ":" in address:
+            (high, low) = IPV6_ADDRESS.unpack(
+                socket.inet_pton(socket.AF_INET6, address))
+            return (high << 64 | low) in SETTINGS['exclude_ipv6_networks']
+        return (IPV4_ADDRESS.unpack(
+            socket.inet_pton(socket.AF_INET, address))[0] in
+            SETTINGS['exclude_ipv4_networks'])
     except socket.error:
         logging.warning("Bad address: %s", address)
         return True
-    return any([(addr & net[1] == net[0]) for net in SETTINGS[key]])
+
+
+def get_excluded(addr_list):
+    """
+    Returns a list of booleans for the network addresses in addr_list from
+    an addr message, True if the address is found in exclusion list. Raw IP
+    addresses are matched without converting them to and from strings.
+    """
+    ipv4_networks = SETTINGS['exclude_ipv4_networks']
+    ipv6_networks = SETTINGS['exclude_ipv6_networks']
+    unpack_ipv4 = IPV4_ADDRESS.unpack_from
+    unpack_ipv6 = IPV6_ADDRESS.unpack
+    excluded = []
+    for peer in addr_list:
+        raw_ip = peer.raw_ip
+        if raw_ip[:12] == IPV4_PREFIX or peer.is_ipv4():
+            excluded.append(unpack_ipv4(raw_ip, 12)[0] in ipv4_networks)
+        elif raw_ip[:6] == ONION_PREFIX:
+            excluded.append(False)
+        else:
+            (high, low) = unpack_ipv6(raw_ip)
+            excluded.append((high << 64 | low) in ipv6_networks)
+    return excluded
+
+
+def get_networks(networks):
+    """
+    Returns list of tuples of network address and broadcast address for the
+    valid networks from the specified list of networks in CIDR notation.
+    """
+    tuples = []
+    for network in networks:
+        try:
+            network = ip_network(unicode(network))
+        except ValueError:
+            continue
+        tuples.append((int(network.network_address),
+                       int(network.broadcast_address)))
+    return tuples
 
 
 def init_settings(argv):
@@ -305,6 +536,7 @@ def init_settings(argv):
     SETTINGS['logfile'] = conf.get('crawl', 'logfile')
     SETTINGS['seeders'] = conf.get('crawl', 'seeders').strip().split("\n")
     SETTINGS['workers'] = conf.getint('crawl', 'workers')
+    SETTINGS['claim_size'] = conf.getint('crawl', 'claim_size')
     SETTINGS['debug'] = conf.getboolean('crawl', 'debug')
     SETTINGS['source_address'] = conf.get('crawl', 'source_address')
     SETTINGS['protocol_version'] = conf.getint('crawl', 'protocol_version')
@@ -312,36 +544,28 @@ def init_settings(argv):
     SETTINGS['services'] = conf.getint('crawl', 'services')
     SETTINGS['relay'] = conf.getint('crawl', 'relay')
     SETTINGS['socket_timeout'] = conf.getint('crawl', 'socket_timeout')
+    SETTINGS['node_timeout'] = conf.getint('crawl', 'node_timeout')
+    SETTINGS['max_addr'] = conf.getint('crawl', 'max_addr')
+    SETTINGS['addr_idle_timeout'] = conf.getfloat('crawl',
+                                                  'addr_idle_timeout')
     SETTINGS['cron_delay'] = conf.getint('crawl', 'cron_delay')
     SETTINGS['max_age'] = conf.getint('crawl', 'max_age')
+    SETTINGS['round_ttl'] = conf.getint('crawl', 'round_ttl')
     SETTINGS['ipv6'] = conf.getboolean('crawl', 'ipv6')
+    SETTINGS['max_peers_filter'] = conf.getint('crawl', 'max_peers_filter')
 
     exclude_ipv4_networks = conf.get(
         'crawl', 'exclude_ipv4_networks').strip().split("\n")
     exclude_ipv6_networks = conf.get(
         'crawl', 'exclude_ipv6_networks').strip().split("\n")
 
-    # List of tuples of network address and netmask
-    SETTINGS['exclude_ipv4_networks'] = []
-    SETTINGS['exclude_ipv6_networks'] = []
-
-    for network in exclude_ipv4_networks:
-        try:
-            network = ip_network(unicode(network))
-        except ValueError:
-            continue
-        SETTINGS['exclude_ipv4_networks'].append(
-            (int(network.network_address), int(network.netmask)))
-
-    for network in exclude_ipv6_networks:
-        try:
-            network = ip_network(unicode(network))
-        except ValueError:
-            continue
-        SETTINGS['exclude_ipv6_networks'].append(
-            (int(network.network_address), int(network.netmask)))
+    SETTINGS['exclude_ipv4_networks'] = NetworkIndex(
+        get_networks(exclude_ipv4_networks))
+    SETTINGS['exclude_ipv6_networks'] = NetworkIndex(
+        get_networks(exclude_ipv6_networks))
 
     SETTINGS['crawl_dir'] = conf.get('crawl', 'crawl_dir')
+    SETTINGS['sidecar'] = conf.getboolean('crawl', 'sidecar')
     if not os.path.exists(SETTINGS['crawl_dir']):
         os.makedirs(SETTINGS['crawl_dir'])
 
@@ -350,8 +574,9 @@ def init_settings(argv):
 
 
 def main(argv):
+    (argv, processes) = get_processes(argv)
     if len(argv) < 3 or not os.path.exists(argv[1]):
-        print("Usage: crawl.py [config] [master|slave]")
+        print("Usage: crawl.py [config] [master|slave] [--processes N]")
         return 1
 
     # Initialize global settings
@@ -371,23 +596,38 @@ def main(argv):
     print("Writing output to {}, press CTRL+C to terminate..".format(
         SETTINGS['logfile']))
 
-    if SETTINGS['master']:
+    # Fork worker processes with the first worker as master if set
+    restarted = False
+    if processes > 0:
+        supervisor = Supervisor(processes, SETTINGS['cron_delay'])
+        worker = supervisor.run()
+        if worker is None:
+            return 0
+        SETTINGS['master'] = SETTINGS['master'] and worker == 0
+        restarted = supervisor.restarted
+        gevent.spawn(report_status, SETTINGS['cron_delay'])
+
+    # Keys are kept for the other workers if master is restarted
+    if SETTINGS['master'] and not restarted:
         REDIS_CONN.set('crawl:master:state', "starting")
         logging.info("Removing all keys")
-        keys = REDIS_CONN.keys('node:*')
+        round_id = REDIS_CONN.getset('crawl:round', int(time.time()))
         redis_pipe = REDIS_CONN.pipeline()
-        for key in keys:
-            redis_pipe.delete(key)
+        if round_id is not None:
+            redis_pipe.expire(get_round_key(round_id), SETTINGS['round_ttl'])
         redis_pipe.delete('pending')
         redis_pipe.execute()
         set_pending()
 
     # Spawn workers (greenlets) including one worker reserved for cron tasks
+    # and one worker reserved for claiming nodes from the crawl set
     workers = []
+    queue = gevent.queue.Queue(SETTINGS['claim_size'])
     if SETTINGS['master']:
         workers.append(gevent.spawn(cron))
+    workers.append(gevent.spawn(claim, queue))
     for _ in xrange(SETTINGS['workers'] - len(workers)):
-        workers.append(gevent.spawn(task))
+        workers.append(gevent.spawn(task, queue))
     logging.info("Workers: %d", len(workers))
     gevent.joinall(workers)
 
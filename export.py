@@ -28,7 +28,6 @@
 Exports enumerated data for reachable nodes into a JSON file.
 """
 
-import json
 import logging
 import os
 import redis
@@ -36,6 +35,9 @@ import sys
 import time
 from ConfigParser import ConfigParser
 
+from codec import GEOIP, OPEN_NODE
+from snapshot import Writer
+
 # Redis connection setup
 REDIS_SOCKET = os.environ.get('REDIS_SOCKET', "/tmp/redis.sock")
 REDIS_PASSWORD = os.environ.get('REDIS_PASSWORD', None)
@@ -44,13 +46,18 @@ REDIS_CONN = redis.StrictRedis(unix_socket_path=REDIS_SOCKET,
 
 SETTINGS = {}
 
+# Column types of rows in snapshot sidecar: address, port, version,
+# user_agent, timestamp, services, height, hostname, city, country, latitude,
+# longitude, timezone, asn, org
+SNAPSHOT_FIELDS = "SHiSIQiSSSddSSS"
+
 
 def get_row(node):
     """
     Returns enumerated row data from Redis for the specified node.
     """
     # address, port, version, user_agent, timestamp, services
-    node = eval(node)
+    node = OPEN_NODE.decode(node)
     address = node[0]
     port = node[1]
 
@@ -68,7 +75,7 @@ def get_row(node):
         # city, country, latitude, longitude, timezone, asn, org
         geoip = (None, None, 0.0, 0.0, None, None, None)
     else:
-        geoip = eval(geoip)
+        geoip = GEOIP.decode(geoip)
 
     return node + height + hostname + geoip
 
@@ -76,19 +83,18 @@ def get_row(node):
 def export_nodes(nodes, timestamp):
     """
     Merges enumerated data for the specified nodes and exports them into
-    timestamp-prefixed JSON file.
+    timestamp-prefixed JSON file. Rows are written to a temporary file as
+    they are merged, which is renamed into place once complete.
     """
-    rows = []
     start = time.time()
-    for node in nodes:
-        row = get_row(node)
-        rows.append(row)
+    dump = os.path.join(SETTINGS['export_dir'], "{}.json".format(timestamp))
+    fields = SNAPSHOT_FIELDS if SETTINGS['sidecar'] else None
+    with Writer(dump, fields=fields, encoding="latin-1") as writer:
+        for node in nodes:
+            writer.write(get_row(node))
     end = time.time()
     elapsed = end - start
     logging.info("Elapsed: %d", elapsed)
-
-    dump = os.path.join(SETTINGS['export_dir'], "{}.json".format(timestamp))
-    open(dump, 'w').write(json.dumps(rows, encoding="latin-1"))
     logging.info("Wrote %s", dump)
 
 
@@ -103,6 +109,7 @@ def init_settings(argv):
     SETTINGS['export_dir'] = conf.get('export', 'export_dir')
     if not os.path.exists(SETTINGS['export_dir']):
         os.makedirs(SETTINGS['export_dir'])
+    SETTINGS['sidecar'] = conf.getboolean('export', 'sidecar')
 
 
 def main(argv):
@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# fakepeer.py - Greenlets-based fake Bitcoin nodes for local benchmarks.
+#
+# Copyright (c) Addy Yeow Chin Heng <ayeowch@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Greenlets-based fake Bitcoin nodes for local benchmarks.
+
+Each fake node listens on its own loopback address (127.0.0.0/8) so that a
+crawler sees a network of distinct nodes. Addr messages from the nodes form
+a synthetic network graph over all the fake nodes.
+"""
+
+from gevent import monkey
+monkey.patch_all()
+
+import binascii
+import gevent
+import gevent.server
+import logging
+import os
+import random
+import socket
+import struct
+import sys
+import time
+from ConfigParser import ConfigParser
+
+from benchmark import get_tx
+from protocol import (ProtocolError, ConnectionError, Connection, Serializer,
+                      sha256)
+
+SETTINGS = {}
+
+# Pre-serialized txs for inv and tx messages sent by fake nodes
+TXS = []
+
+# Behaviours for fake nodes other than the normal behaviour
+TIMEOUT = "timeout"  # accepts connection but never responds
+RESET = "reset"  # resets connection on receiving version message
+BAD_CHECKSUM = "bad_checksum"  # responds to getaddr with bad checksum
+
+
+class FakePeer(object):
+    """
+    Implements a fake node that listens on the specified address and responds
+    to version, getaddr and ping messages from its clients. Ping, inv and tx
+    messages are also sent periodically to each client.
+    """
+    def __init__(self, address, addr_list, behaviour=None):
+        self.address = address
+        self.behaviour = behaviour
+        self.serializer = Serializer()
+        self.addr_msg = self.serializer.serialize_msg(
+            command="addr", addr_list=addr_list)
+        if self.behaviour == BAD_CHECKSUM:
+            checksum = chr(ord(self.addr_msg[20]) ^ 0xFF)
+            self.addr_msg = (self.addr_msg[:20] + checksum +
+                             self.addr_msg[21:])
+        self.server = gevent.server.StreamServer(
+            (self.address, SETTINGS['port']), self.serve,
+            backlog=SETTINGS['backlog'])
+
+    def start(self):
+        self.server.start()
+
+    def serve(self, sock, address):
+        """
+        Responds to messages from the client until it closes the connection.
+        Ping messages are responded to by Connection.get_messages().
+        """
+        conn = Connection(address, (self.address, SETTINGS['port']),
+                          socket_timeout=SETTINGS['socket_timeout'],
+                          decode_commands=["version"])
+        conn.socket = sock
+        gossip = None
+        while True:
+            try:
+                msgs = conn.get_messages()
+            except (ProtocolError, ConnectionError, socket.error) as err:
+                logging.debug("Closing %s (%s)", conn.to_addr, err)
+                break
+            if self.behaviour == TIMEOUT:
+                continue
+            for msg in msgs:
+                if msg['command'] == "version":
+                    if self.behaviour == RESET:
+                        # SO_LINGER with zero timeout to send RST on close
+                        sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                                        struct.pack("ii", 1, 0))
+                        sock.close()
+                        return
+                    self.delay()
+                    # [version] [verack] >>>
+                    conn.send(
+                        self.serializer.serialize_msg(
+                            command="version", to_addr=conn.to_addr,
+                            from_addr=conn.from_addr) +
+                        self.serializer.cached_msg(command="verack"))
+                    if gossip is None:
+                        gossip = gevent.spawn(self.gossip, conn,
+                                              msg.get('relay', False))
+                elif msg['command'] == "getaddr":
+                    self.delay()
+                    # [addr] >>>
+                    conn.send(self.addr_msg)
+        if gossip is not None:
+            gossip.kill()
+        conn.close()
+
+    def gossip(self, conn, relay):
+        """
+        Periodically sends ping and inv messages, and tx messages if the
+        client has set relay in its version message.
+        """
+        last_ping = time.time()
+        while True:
+            gevent.sleep(SETTINGS['inv_interval'])
+            try:
+                if time.time() > last_ping + SETTINGS['ping_interval']:
+                    conn.ping()
+                    last_ping = time.time()
+                txs = random.sample(TXS, SETTINGS['inv_count'])
+                inventory = [
+                    (1, binascii.hexlify(sha256(sha256(tx))[::-1]))
+                    for tx in txs
+                ]
+                conn.inv(inventory)
+                if relay:
+                    conn.send("".join([
+                        self.serializer.frame_msg("tx", tx) for tx in txs]))
+            except socket.error:
+                break
+
+    def delay(self):
+        """
+        Simulates network latency before responding to a message.
+        """
+        latency = random.uniform(
+            SETTINGS['latency'] - SETTINGS['latency_jitter'],
+            SETTINGS['latency'] + SETTINGS['latency_jitter'])
+        if latency > 0:
+            gevent.sleep(latency / 1000.0)  # ms
+
+
+def get_addresses(count):
+    """
+    Returns loopback addresses for the specified number of fake nodes
+    starting from the configured address.
+    """
+    start = struct.unpack(">I", socket.inet_aton(SETTINGS['address']))[0]
+    return [socket.inet_ntoa(struct.pack(">I", start + idx))
+            for idx in xrange(count)]
+
+
+def get_peers():
+    """
+    Returns fake nodes with their addr messages containing random subsets of
+    all the fake nodes to form a network graph. Behaviour for each fake node
+    is assigned randomly using the configured rates except for the first fake
+    node which always behaves normally to serve as a seed node.
+    """
+    addresses = get_addresses(SETTINGS['peers'])
+    degree = min(SETTINGS['degree'], len(addresses))
+    now = int(time.time())
+    peers = []
+    for idx, address in enumerate(addresses):
+        addr_list = [(now - random.randint(0, 3600), 1, peer,
+                      SETTINGS['port'])
+                     for peer in random.sample(addresses, degree)]
+        behaviour = None
+        rate = random.random() if idx > 0 else 1.0
+        for (name, key) in ((TIMEOUT, 'timeout_rate'),
+                            (RESET, 'reset_rate'),
+                            (BAD_CHECKSUM, 'bad_checksum_rate')):
+            if rate < SETTINGS[key]:
+                behaviour = name
+                break
+            rate -= SETTINGS[key]
+        peers.append(FakePeer(address, addr_list, behaviour))
+    return peers
+
+
+def init_settings(argv):
+    """
+    Populates SETTINGS with key-value pairs from configuration file.
+    """
+    conf = ConfigParser()
+    conf.read(argv[1])
+    SETTINGS['logfile'] = conf.get('fakepeer', 'logfile')
+    SETTINGS['debug'] = conf.getboolean('fakepeer', 'debug')
+    SETTINGS['address'] = conf.get('fakepeer', 'address')
+    SETTINGS['port'] = conf.getint('fakepeer', 'port')
+    SETTINGS['peers'] = conf.getint('fakepeer', 'peers')
+    SETTINGS['degree'] = conf.getint('fakepeer', 'degree')
+    SETTINGS['backlog'] = conf.getint('fakepeer', 'backlog')
+    SETTINGS['socket_timeout'] = conf.getint('fakepeer', 'socket_timeout')
+    SETTINGS['latency'] = conf.getfloat('fakepeer', 'latency')
+    SETTINGS['latency_jitter'] = conf.getfloat('fakepeer', 'latency_jitter')
+    SETTINGS['ping_interval'] = conf.getfloat('fakepeer', 'ping_interval')
+    SETTINGS['inv_interval'] = conf.getfloat('fakepeer', 'inv_interval')
+    SETTINGS['inv_count'] = conf.getint('fakepeer', 'inv_count')
+    SETTINGS['timeout_rate'] = conf.getfloat('fakepeer', 'timeout_rate')
+    SETTINGS['reset_rate'] = conf.getfloat('fakepeer', 'reset_rate')
+    SETTINGS['bad_checksum_rate'] = conf.getfloat('fakepeer',
+                                                  'bad_checksum_rate')
+    SETTINGS['seed'] = conf.getint('fakepeer', 'seed')
+
+
+def main(argv):
+    if len(argv) < 2 or not os.path.exists(argv[1]):
+        print("Usage: fakepeer.py [config]")
+        return 1
+
+    # Initialize global settings
+    init_settings(argv)
+
+    # Initialize logger
+    loglevel = logging.INFO
+    if SETTINGS['debug']:
+        loglevel = logging.DEBUG
+
+    logformat = ("[%(process)d] %(asctime)s,%(msecs)05.1f %(levelname)s "
+                 "(%(funcName)s) %(message)s")
+    logging.basicConfig(level=loglevel,
+                        format=logformat,
+                        filename=SETTINGS['logfile'],
+                        filemode='a')
+    print("Writing output to {}, press CTRL+C to terminate..".format(
+        SETTINGS['logfile']))
+
+    random.seed(SETTINGS['seed'])
+    serializer = Serializer()
+    TXS.extend([get_tx(serializer)
+                for _ in xrange(max(100, SETTINGS['inv_count']))])
+    peers = get_peers()
+    for peer in peers:
+        peer.start()
+    logging.info("Listening on %s-%s:%d (%d nodes)", peers[0].address,
+                 peers[-1].address, SETTINGS['port'], len(peers))
+    for behaviour in (TIMEOUT, RESET, BAD_CHECKSUM):
+        logging.info("%s: %d", behaviour,
+                     len([p for p in peers if p.behaviour == behaviour]))
+    gevent.wait()
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
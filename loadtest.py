@@ -0,0 +1,453 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# loadtest.py - Connection benchmarks against local fake Bitcoin nodes.
+#
+# Copyright (c) Addy Yeow Chin Heng <ayeowch@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Connection benchmarks against local fake Bitcoin nodes (see fakepeer.py).
+
+Benchmarks:
+gevent  - concurrent connections to the seed node using protocol.Connection
+asyncio - concurrent connections to the seed node using aioprotocol.Connection
+crawl   - crawl of the fake network starting from the seed node
+keepalive      - open connections to the seed node kept alive by
+                 ping.Multiplexer
+keepalive_poll - open connections to the seed node kept alive by one
+                 polling worker (greenlet) for each connection
+
+Each benchmark is run in its own process as gevent requires the standard
+library to be monkey-patched while asyncio must run without it.
+"""
+
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+from ConfigParser import ConfigParser
+
+SETTINGS = {}
+
+
+def bench_gevent(to_addr, connections):
+    """
+    Concurrently opens the specified number of connections using
+    protocol.Connection and returns the handshake latencies and error count.
+    """
+    from gevent import monkey
+    monkey.patch_all()
+
+    import gevent
+    import socket
+    from protocol import ProtocolError, ConnectionError, Connection
+
+    latencies = []
+    errors = []
+    conns = []
+
+    def connect():
+        conn = Connection(to_addr, socket_timeout=SETTINGS['socket_timeout'])
+        conns.append(conn)
+        start = time.time()
+        try:
+            conn.open()
+            (handshake_msgs, addr_msgs) = conn.handshake_getaddr()
+        except (ProtocolError, ConnectionError, socket.error) as err:
+            errors.append(err)
+            return
+        if len(handshake_msgs) == 0:
+            errors.append(handshake_msgs)
+            return
+        latencies.append(time.time() - start)
+
+    gevent.joinall([gevent.spawn(connect) for _ in xrange(connections)])
+    for conn in conns:
+        conn.close()
+    return (latencies, len(errors))
+
+
+def bench_asyncio(to_addr, connections):
+    """
+    Concurrently opens the specified number of connections using
+    aioprotocol.Connection and returns the handshake latencies and error
+    count.
+    """
+    from aioprotocol import asyncio, Connection
+
+    loop = asyncio.get_event_loop()
+    latencies = []
+    errors = []
+    conns = []
+
+    def connect():
+        conn = Connection(to_addr, loop=loop,
+                          socket_timeout=SETTINGS['socket_timeout'])
+        conns.append(conn)
+        start = time.time()
+        done = asyncio.Future(loop=loop)
+
+        def handshake_done(future):
+            if future.exception() is not None:
+                errors.append(future.exception())
+            elif len(future.result()[0]) == 0:
+                errors.append(future.result())
+            else:
+                latencies.append(time.time() - start)
+            done.set_result(None)
+
+        def open_done(future):
+            if future.exception() is not None:
+                errors.append(future.exception())
+                done.set_result(None)
+                return
+            conn.handshake_getaddr().add_done_callback(handshake_done)
+
+        conn.open().add_done_callback(open_done)
+        return done
+
+    loop.run_until_complete(
+        asyncio.gather(*[connect() for _ in xrange(connections)], loop=loop))
+    for conn in conns:
+        conn.close()
+    return (latencies, len(errors))
+
+
+def bench_crawl(to_addr, connections):
+    """
+    Crawls the fake network starting from the seed node using
+    protocol.Connection in the same way as crawl.py, without Redis, and
+    returns the handshake latencies, error count and number of nodes crawled
+    as connections. The specified number of connections is used as the
+    number of workers.
+    """
+    from gevent import monkey
+    monkey.patch_all()
+
+    import gevent.pool
+    import gevent.queue
+    import socket
+    from protocol import ProtocolError, ConnectionError, Connection
+
+    latencies = []
+    errors = []
+    nodes = set([to_addr])
+    pending = gevent.queue.Queue()
+    pending.put(to_addr)
+
+    def connect(node):
+        conn = Connection(node, socket_timeout=SETTINGS['socket_timeout'])
+        start = time.time()
+        try:
+            conn.open()
+            (handshake_msgs, addr_msgs) = conn.handshake_getaddr(
+                timeout=SETTINGS['node_timeout'],
+                max_addr=SETTINGS['max_addr'],
+                idle_timeout=SETTINGS['addr_idle_timeout'])
+        except (ProtocolError, ConnectionError, socket.error) as err:
+            errors.append(err)
+            return
+        finally:
+            conn.close()
+        if len(handshake_msgs) == 0:
+            errors.append(handshake_msgs)
+            return
+        latencies.append(time.time() - start)
+        for addr_msg in addr_msgs:
+            for peer in addr_msg['addr_list']:
+                node = (peer['ipv4'] or peer['ipv6'], peer['port'])
+                if node not in nodes:
+                    nodes.add(node)
+                    pending.put(node)
+
+    pool = gevent.pool.Pool(connections)
+    while True:
+        try:
+            node = pending.get(timeout=0.1)
+        except gevent.queue.Empty:
+            if pool.free_count() == pool.size:
+                break
+            continue
+        pool.spawn(connect, node)
+    pool.join()
+    return (latencies, len(errors), {'connections': len(nodes)})
+
+
+def open_keepalive_conns(to_addr, connections):
+    """
+    Opens the specified number of connections to the seed node using the
+    configured number of concurrent workers and returns the handshake
+    latencies, error count and the connections with their version messages.
+    """
+    import gevent.pool
+    import socket
+    from protocol import ProtocolError, ConnectionError, Connection
+
+    latencies = []
+    errors = []
+    conns = []
+
+    def connect():
+        conn = Connection(to_addr, socket_timeout=SETTINGS['socket_timeout'],
+                          decode_commands=["version"])
+        start = time.time()
+        try:
+            conn.open()
+            handshake_msgs = conn.handshake()
+        except (ProtocolError, ConnectionError, socket.error) as err:
+            conn.close()
+            errors.append(err)
+            return
+        if len(handshake_msgs) == 0:
+            conn.close()
+            errors.append(handshake_msgs)
+            return
+        latencies.append(time.time() - start)
+        conns.append((conn, handshake_msgs[0]))
+
+    pool = gevent.pool.Pool(SETTINGS['workers'])
+    for _ in xrange(connections):
+        pool.spawn(connect)
+    pool.join()
+    return (latencies, errors, conns)
+
+
+def get_cpu_pct(func, seconds):
+    """
+    Returns CPU usage in percent of this process while func() runs for the
+    specified number of seconds.
+    """
+    import gevent
+
+    start = resource.getrusage(resource.RUSAGE_SELF)
+    worker = gevent.spawn(func)
+    gevent.sleep(seconds)
+    end = resource.getrusage(resource.RUSAGE_SELF)
+    worker.kill()
+    cpu = (end.ru_utime + end.ru_stime) - (start.ru_utime + start.ru_stime)
+    return cpu * 100.0 / seconds
+
+
+def bench_keepalive(to_addr, connections):
+    """
+    Opens the specified number of connections and keeps them alive for
+    hold_time seconds with ping.Multiplexer, without Redis, and returns the
+    handshake latencies, error count and CPU usage while the connections are
+    kept alive.
+    """
+    from gevent import monkey
+    monkey.patch_all()
+
+    from ping import Keepalive, Multiplexer
+
+    class BenchKeepalive(Keepalive):
+        def open(self):
+            pass
+
+        def close(self):
+            self.conn.close()
+
+        def keepalive(self, sampler):
+            self.conn.ping()
+            self.last_ping = time.time()
+
+    (latencies, errors, conns) = open_keepalive_conns(to_addr, connections)
+    multiplexer = Multiplexer(jitter=0.1)
+    multiplexer.keepalive_time = SETTINGS['keepalive_time']
+    for (conn, version_msg) in conns:
+        multiplexer.add(BenchKeepalive(conn, version_msg))
+    idle_cpu_pct = get_cpu_pct(multiplexer.run, SETTINGS['hold_time'])
+    errors.extend([None] * (len(conns) - len(multiplexer)))  # closed
+    return (latencies, len(errors), {'idle_cpu_pct': idle_cpu_pct})
+
+
+def bench_keepalive_poll(to_addr, connections):
+    """
+    Same as bench_keepalive() but each connection is kept alive by its own
+    polling worker (greenlet) as in ping.py before the multiplexer.
+    """
+    from gevent import monkey
+    monkey.patch_all()
+
+    import gevent
+    import socket
+    from protocol import ProtocolError, ConnectionError
+
+    (latencies, errors, conns) = open_keepalive_conns(to_addr, connections)
+
+    def keepalive(conn):
+        last_ping = time.time()
+        while True:
+            if time.time() > last_ping + SETTINGS['keepalive_time']:
+                conn.ping()
+                last_ping = time.time()
+            try:
+                conn.get_messages()
+            except socket.timeout:
+                pass
+            except (ProtocolError, ConnectionError, socket.error) as err:
+                errors.append(err)
+                break
+            gevent.sleep(0.3)
+
+    def keepalive_all():
+        gevent.joinall([gevent.spawn(keepalive, conn)
+                        for (conn, _) in conns])
+
+    idle_cpu_pct = get_cpu_pct(keepalive_all, SETTINGS['hold_time'])
+    return (latencies, len(errors), {'idle_cpu_pct': idle_cpu_pct})
+
+
+BENCHMARKS = {
+    'gevent': bench_gevent,
+    'asyncio': bench_asyncio,
+    'crawl': bench_crawl,
+    'keepalive': bench_keepalive,
+    'keepalive_poll': bench_keepalive_poll,
+}
+
+
+def percentile(values, pct):
+    """
+    Returns the specified percentile (0-100) of the sorted values.
+    """
+    if len(values) == 0:
+        return 0
+    return values[int(round((len(values) - 1) * pct / 100.0))]
+
+
+def run_benchmark(name):
+    """
+    Runs the specified benchmark and returns the results as a dict.
+    """
+    to_addr = (SETTINGS['fakepeer_address'], SETTINGS['fakepeer_port'])
+    connections = SETTINGS['connections']
+    if name == "crawl":
+        connections = SETTINGS['workers']
+
+    start = time.time()
+    result = BENCHMARKS[name](to_addr, connections)
+    elapsed = time.time() - start
+
+    latencies = sorted(result[0])
+    errors = result[1]
+    extra = {'idle_cpu_pct': 0.0}
+    if len(result) > 2:
+        extra.update(result[2])
+    connections = extra.pop('connections', connections)
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    extra.update({
+        'benchmark': name,
+        'connections': connections,
+        'errors': errors,
+        'elapsed': elapsed,
+        'connections_per_sec': connections / elapsed,
+        'handshake_p50_ms': percentile(latencies, 50) * 1000,
+        'handshake_p99_ms': percentile(latencies, 99) * 1000,
+        'cpu_sec_per_1000': (
+            (usage.ru_utime + usage.ru_stime) * 1000.0 / connections),
+        'maxrss_mb_per_1000': (
+            usage.ru_maxrss / 1024.0 * 1000.0 / connections),  # KB on Linux
+    })
+    return extra
+
+
+def run_all(argv):
+    """
+    Starts fakepeer.py and runs each configured benchmark against it in a
+    separate process.
+    """
+    fakepeer = subprocess.Popen(
+        [sys.executable, "fakepeer.py", SETTINGS['fakepeer_conf']],
+        stdout=open(os.devnull, 'w'))
+    time.sleep(SETTINGS['startup_delay'])
+
+    results = []
+    try:
+        for name in SETTINGS['benchmarks']:
+            output = subprocess.check_output(
+                [sys.executable, argv[0], argv[1], name])
+            results.append(json.loads(output.strip().split("\n")[-1]))
+    finally:
+        fakepeer.terminate()
+        fakepeer.wait()
+
+    keys = [
+        'connections', 'errors', 'elapsed', 'connections_per_sec',
+        'handshake_p50_ms', 'handshake_p99_ms', 'cpu_sec_per_1000',
+        'maxrss_mb_per_1000', 'idle_cpu_pct',
+    ]
+    print("{:<20}".format("") + "".join(
+        ["{:>16}".format(result['benchmark']) for result in results]))
+    for key in keys:
+        print("{:<20}".format(key) + "".join(
+            ["{:>16.2f}".format(result[key]) for result in results]))
+
+
+def init_settings(argv):
+    """
+    Populates SETTINGS with key-value pairs from configuration file.
+    """
+    conf = ConfigParser()
+    conf.read(argv[1])
+    SETTINGS['fakepeer_conf'] = conf.get('loadtest', 'fakepeer_conf')
+    SETTINGS['benchmarks'] = conf.get(
+        'loadtest', 'benchmarks').strip().split("\n")
+    SETTINGS['connections'] = conf.getint('loadtest', 'connections')
+    SETTINGS['workers'] = conf.getint('loadtest', 'workers')
+    SETTINGS['socket_timeout'] = conf.getint('loadtest', 'socket_timeout')
+    SETTINGS['node_timeout'] = conf.getint('loadtest', 'node_timeout')
+    SETTINGS['max_addr'] = conf.getint('loadtest', 'max_addr')
+    SETTINGS['addr_idle_timeout'] = conf.getfloat('loadtest',
+                                                  'addr_idle_timeout')
+    SETTINGS['keepalive_time'] = conf.getint('loadtest', 'keepalive_time')
+    SETTINGS['hold_time'] = conf.getint('loadtest', 'hold_time')
+    SETTINGS['startup_delay'] = conf.getint('loadtest', 'startup_delay')
+
+    fakepeer_conf = ConfigParser()
+    fakepeer_conf.read(SETTINGS['fakepeer_conf'])
+    SETTINGS['fakepeer_address'] = fakepeer_conf.get('fakepeer', 'address')
+    SETTINGS['fakepeer_port'] = fakepeer_conf.getint('fakepeer', 'port')
+
+
+def main(argv):
+    if len(argv) < 2 or not os.path.exists(argv[1]):
+        print("Usage: loadtest.py [config] [{}]".format(
+            "|".join(sorted(BENCHMARKS.keys()))))
+        return 1
+
+    # Initialize global settings
+    init_settings(argv)
+
+    if len(argv) > 2:
+        print(json.dumps(run_benchmark(argv[2])))
+    else:
+        run_all(argv)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -82,7 +82,7 @@ class Cache(object):
     def __init__(self, filepath):
         self.filepath = filepath
         self.redis_pipe = REDIS_CONN.pipeline()
-        self.serializer = Serializer()
+        self.serializer = Serializer(decode_commands=["inv", "pong"])
         self.streams = defaultdict(PriorityQueue)
         self.stream = Stream()
         self.count = 0
@@ -96,21 +96,25 @@ class Cache(object):
         for stream_id, self.stream.segments in self.streams.iteritems():
             data = self.stream.data()
             _data = data.next()
+            offset = 0
             while True:
                 try:
-                    (msg, _data) = self.serializer.deserialize_msg(_data)
+                    (msg, offset) = self.serializer.deserialize_msg_from(
+                        _data, offset)
                 except (HeaderTooShortError, PayloadTooShortError) as err:
                     logging.debug("%s: %s", stream_id, err)
                     try:
-                        _data += data.next()
+                        _data = _data[offset:] + data.next()
                     except StopIteration:
                         break
+                    offset = 0
                 except ProtocolError as err:
                     logging.debug("%s: %s", stream_id, err)
                     try:
                         _data = data.next()
                     except StopIteration:
                         break
+                    offset = 0
                 else:
                     node = (stream_id[0], stream_id[1])
                     self.cache_message(node, self.stream.timestamp, msg)
@@ -32,20 +32,26 @@ from gevent import monkey
 monkey.patch_all()
 
 import gevent
+import gevent.event
 import gevent.pool
 import glob
-import json
 import logging
+import math
 import os
 import random
 import redis
 import redis.connection
 import socket
+import struct
 import sys
 import time
 from ConfigParser import ConfigParser
 
-from protocol import ProtocolError, ConnectionError, Connection
+from codec import (DecodeError, OPEN_ADDR, OPEN_NODE, REACHABLE_NODE,
+                   decode_legacy)
+from protocol import ProtocolError, ConnectionError, Connection, Serializer
+from snapshot import load as load_snapshot
+from supervisor import STATUS, Supervisor, get_processes, report_status
 
 redis.connection.socket = gevent.socket
 
@@ -57,61 +63,133 @@ REDIS_CONN = redis.StrictRedis(unix_socket_path=REDIS_SOCKET,
 
 SETTINGS = {}
 
+# Max. keys in each Redis batch read
+REDIS_BATCH_SIZE = 1000
+
+# Max. nodes in each addr message sent to a node
+ADDR_COUNT = 10
+
+# Max. seconds between retries of Redis writes
+MAX_RETRY_DELAY = 60
+
+
+class WriteQueue(object):
+    """
+    Queues Redis writes from all workers in this process and executes them
+    in a pipeline from a single worker every redis_flush_interval ms or once
+    redis_flush_size writes are queued. Writes are executed in the order
+    they are queued. Writes that fail to reach Redis are retried ahead of
+    newer writes with exponential backoff of up to MAX_RETRY_DELAY seconds.
+    Keys that are also written directly, e.g. the open set, must not be
+    queued as the queued writes may then be applied out of order.
+    """
+    def __init__(self):
+        self.writes = []  # (command, args)
+        self.wakeup = gevent.event.Event()
+
+    def __len__(self):
+        return len(self.writes)
+
+    def queue(self, command, *args):
+        """
+        Queues the specified Redis command, e.g. queue('sadd', key, value).
+        """
+        self.writes.append((command, args))
+        if len(self.writes) >= SETTINGS['redis_flush_size']:
+            self.wakeup.set()
+
+    def run(self):
+        """
+        Executes queued writes until the process is terminated. Only this
+        worker executes the pipeline so that a batch is never executed before
+        the batch queued ahead of it.
+        """
+        interval = SETTINGS['redis_flush_interval'] / 1000.0
+        delay = 0
+        while True:
+            self.wakeup.wait(interval)
+            self.wakeup.clear()
+            if len(self.writes) == 0:
+                continue
+            (writes, self.writes) = (self.writes, [])
+            redis_pipe = REDIS_CONN.pipeline(transaction=False)
+            for (command, args) in writes:
+                getattr(redis_pipe, command)(*args)
+            try:
+                redis_pipe.execute()
+            except (redis.ConnectionError, redis.TimeoutError) as err:
+                self.writes[:0] = writes  # retry before newer writes
+                delay = min(max(delay * 2, 1), MAX_RETRY_DELAY)
+                logging.warning("Retrying %d writes in %d seconds: %s",
+                                len(self.writes), delay, err)
+                gevent.sleep(delay)
+                continue
+            except redis.RedisError as err:
+                # Executed but rejected by Redis, e.g. WRONGTYPE
+                logging.warning("Failed %d writes: %s", len(writes), err)
+            delay = 0
+            STATUS['writes'] += len(writes)
+
+
+# Write-behind queue for Redis writes that are not read back by the caller
+REDIS_QUEUE = WriteQueue()
+
 
 class Keepalive(object):
     """
     Implements keepalive mechanic to keep the specified connection with a node.
+    Connection is read and kept alive by the multiplexer once it is opened.
     """
     def __init__(self, conn, version_msg):
         self.conn = conn
         self.node = conn.to_addr
         self.version_msg = version_msg
         self.last_ping = int(time.time())
-        self.keepalive_time = 60
+        self.last_nonce = None
         self.last_bestblockhash = None
 
-    def keepalive(self):
-        """
-        Periodically sends the following messages:
-        1) ping message
-        2) inv message for the consensus block
-        3) addr message containing a subset of the reachable nodes
-        Open connections are tracked in open set with the associated data
-        stored in opendata set in Redis.
-        """
-        version = self.version_msg.get('version', "")
+        version = self.version_msg.get('version', 0)
         user_agent = self.version_msg.get('user_agent', "")
-        services = self.version_msg.get('services', "")
-        data = self.node + (version, user_agent, self.last_ping, services)
+        services = self.version_msg.get('services', 0)
+        self.data = OPEN_NODE.encode(
+            self.node + (version, user_agent, self.last_ping, services))
 
-        REDIS_CONN.sadd('opendata', data)
+    def open(self):
+        """
+        Adds the node into opendata set in Redis.
+        """
+        REDIS_QUEUE.queue('sadd', 'opendata', self.data)
 
-        while True:
-            if time.time() > self.last_ping + self.keepalive_time:
-                try:
-                    self.ping()
-                    self.send_bestblockhash()
-                    self.send_addr()
-                except socket.error as err:
-                    logging.debug("Closing %s (%s)", self.node, err)
-                    break
+    def close(self):
+        """
+        Closes the connection and removes the node from open and opendata set
+        in Redis.
+        """
+        self.conn.close()
+        REDIS_QUEUE.queue('srem', 'opendata', self.data)
+        # open is written synchronously, see task()
+        try:
+            REDIS_CONN.srem('open', OPEN_ADDR.encode(self.node))
+        except redis.RedisError as err:
+            logging.warning("%s: %s", self.node, err)
 
-            # Sink received messages to flush them off socket buffer
-            try:
-                self.conn.get_messages()
-            except socket.timeout:
-                pass
-            except (ProtocolError, ConnectionError, socket.error) as err:
-                logging.debug("Closing %s (%s)", self.node, err)
-                break
-            gevent.sleep(0.3)
+    def keepalive(self, sampler):
+        """
+        Sends the following messages:
+        1) ping message
+        2) addr message containing a subset of the reachable nodes from the
+           specified sampler
 
-        REDIS_CONN.srem('opendata', data)
+        Inv message for the consensus block is broadcasted by the multiplexer.
+        """
+        self.ping()
+        self.send_addr(sampler)
 
     def ping(self):
         """
         Sends a ping message. Ping time is stored in Redis for round-trip time
-        (RTT) calculation.
+        (RTT) calculation by pcap.py unless RTT is measured in this process
+        from the pong message.
         """
         nonce = random.getrandbits(64)
         try:
@@ -120,69 +198,387 @@ class Keepalive(object):
             raise
 
         self.last_ping = time.time()
+        self.last_nonce = nonce
+        STATUS['pings'] += 1
+        if SETTINGS['rtt']:
+            return
         key = "ping:{}-{}:{}".format(self.node[0], self.node[1], nonce)
-        REDIS_CONN.lpush(key, int(self.last_ping * 1000))  # in ms
-        REDIS_CONN.expire(key, SETTINGS['ttl'])
+        REDIS_QUEUE.queue('lpush', key, int(self.last_ping * 1000))  # in ms
+        REDIS_QUEUE.queue('expire', key, SETTINGS['ttl'])
 
-        try:
-            self.keepalive_time = int(REDIS_CONN.get('elapsed'))
-        except TypeError:
-            pass
+    def get_rtt(self, msg):
+        """
+        Returns RTT in ms for the specified pong message or None if it is not
+        for the last ping.
+        """
+        if msg.get('nonce') != self.last_nonce or self.last_nonce is None:
+            return None
+        self.last_nonce = None
+        return int((msg['received'] - self.last_ping) * 1000)
 
-    def send_bestblockhash(self):
+    def send_bestblockhash(self, bestblockhash, msg):
         """
-        Sends an inv message for the consensus block.
+        Sends the specified pre-serialized inv message for the consensus block
+        if it has not been sent to the node.
         """
-        bestblockhash = REDIS_CONN.get('bestblockhash')
         if self.last_bestblockhash == bestblockhash:
             return
         try:
-            self.conn.inv(inventory=[(2, bestblockhash)])
+            self.conn.send(msg)
         except socket.error:
             raise
         self.last_bestblockhash = bestblockhash
 
-    def send_addr(self):
+    def send_addr(self, sampler):
         """
         Sends an addr message containing a subset of the reachable nodes.
         """
-        nodes = REDIS_CONN.srandmember('opendata', 10)
-        nodes = [eval(node) for node in nodes]
-        addr_list = []
-        timestamp = int(self.last_ping)  # Timestamp less than 10 minutes old
-        for node in nodes:
-            # address, port, version, user_agent, timestamp, services
-            address = node[0]
-            port = node[1]
-            services = node[-1]
-            if address == self.node[0]:
-                continue
-            if services != 1:  # Skip if not NODE_NETWORK
-                continue
-            addr_list.append((timestamp, services, address, port))
-        if len(addr_list) == 0:
+        records = sampler.sample(ADDR_COUNT, exclude=self.node[0])
+        if len(records) == 0:
             return
+        # Timestamp less than 10 minutes old
+        timestamp = struct.pack("<I", int(self.last_ping))
+        serializer = self.conn.serializer
+        payload = serializer.serialize_int(len(records)) + "".join(
+            [timestamp + record for record in records])
         try:
-            self.conn.addr(addr_list=addr_list)
+            self.conn.send(serializer.frame_msg("addr", payload))
         except socket.error:
             raise
 
 
-def task():
+class AddrSampler(object):
+    """
+    Keeps the NODE_NETWORK nodes in opendata set as pre-serialized network
+    addresses without timestamp (26 bytes) for addr messages. Nodes are
+    added and removed incrementally by refresh() so that each node in the
+    set is decoded and serialized only once.
+    """
+    def __init__(self):
+        self.serializer = Serializer()
+        self.members = {}  # member: index in records or None if ineligible
+        self.keys = []  # member for each record
+        self.addresses = []
+        self.records = []
+
+    def __len__(self):
+        return len(self.records)
+
+    def refresh(self):
+        """
+        Adds new nodes and removes nodes no longer in opendata set in Redis.
+        """
+        seen = set()
+        for member in REDIS_CONN.sscan_iter('opendata',
+                                            count=REDIS_BATCH_SIZE):
+            seen.add(member)
+            if member not in self.members:
+                self.add(member)
+        for member in set(self.members) - seen:
+            self.remove(member)
+
+    def add(self, member):
+        self.members[member] = None
+        try:
+            node = OPEN_NODE.decode(member)
+        except DecodeError as err:
+            logging.warning(err)
+            return
+        # address, port, version, user_agent, timestamp, services
+        (address, port, services) = (node[0], node[1], node[-1])
+        if services != 1:  # Skip if not NODE_NETWORK
+            return
+        self.members[member] = len(self.records)
+        self.keys.append(member)
+        self.addresses.append(address)
+        self.records.append(self.serializer.serialize_network_address(
+            (services, address, port)))
+
+    def remove(self, member):
+        # Moves the last node into the removed node's index
+        idx = self.members.pop(member)
+        if idx is None:
+            return
+        last = self.keys.pop()
+        address = self.addresses.pop()
+        record = self.records.pop()
+        if last != member:
+            self.members[last] = idx
+            self.keys[idx] = last
+            self.addresses[idx] = address
+            self.records[idx] = record
+
+    def sample(self, count, exclude=None):
+        """
+        Returns up to count random records, excluding the node with the
+        specified address.
+        """
+        indexes = random.sample(xrange(len(self.records)),
+                                min(count + 1, len(self.records)))
+        return [self.records[idx] for idx in indexes
+                if self.addresses[idx] != exclude][:count]
+
+
+class TimerWheel(object):
+    """
+    Hierarchical timer wheel with the specified tick in seconds. Each level
+    has 2**bits slots and each slot in a level spans one full rotation of
+    the level below it, e.g. 256 ticks of 1 second in level 0 and 256 slots
+    of 256 seconds in level 1. Timers are added into the lowest level that
+    covers them and moved down a level (cascaded) as the level below wraps
+    around, so that adding a timer and advancing a tick are both O(1).
+    """
+    def __init__(self, tick, levels=3, bits=8):
+        self.tick = tick
+        self.bits = bits
+        self.mask = (1 << bits) - 1
+        self.levels = [[[] for _ in xrange(1 << bits)]
+                       for _ in xrange(levels)]
+        self.current = int(time.time() / tick)  # last tick advanced to
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def add(self, when, item):
+        """
+        Adds a timer for the item to expire at the specified time.
+        """
+        expires = max(int(math.ceil(when / self.tick)), self.current + 1)
+        self.insert(expires, item)
+        self.count += 1
+
+    def insert(self, expires, item):
+        delta = expires - self.current
+        for (level, slots) in enumerate(self.levels):
+            if (delta >> (self.bits * (level + 1)) == 0 or
+                    level == len(self.levels) - 1):
+                idx = (expires >> (self.bits * level)) & self.mask
+                slots[idx].append((expires, item))
+                return
+
+    def next_tick(self):
+        """
+        Returns the time of the next tick.
+        """
+        return (self.current + 1) * self.tick
+
+    def advance(self, now):
+        """
+        Advances the wheel up to the specified time and returns the items of
+        all timers that have expired.
+        """
+        items = []
+        target = int(now / self.tick)
+        while self.current < target:
+            self.current += 1
+            for level in xrange(1, len(self.levels)):
+                if self.current & ((1 << (self.bits * level)) - 1):
+                    break
+                idx = (self.current >> (self.bits * level)) & self.mask
+                (timers, self.levels[level][idx]) = (
+                    self.levels[level][idx], [])
+                for (expires, item) in timers:
+                    self.insert(expires, item)
+            idx = self.current & self.mask
+            (timers, self.levels[0][idx]) = (self.levels[0][idx], [])
+            items.extend([item for (_, item) in timers])
+        self.count -= len(items)
+        return items
+
+
+class Multiplexer(object):
+    """
+    Keeps all open connections in this process alive from a single worker.
+    Each socket is watched by the gevent event loop (epoll on Linux) which
+    queues the socket to be read only once data has arrived, while the next
+    keepalive for each connection is scheduled in a timer wheel. The worker
+    sleeps until either is due and keeps alive all due connections at once.
+    Keepalive interval is cached and refreshed by refresh(). Inv message for
+    a new consensus block is serialized once and broadcasted to all
+    connections by broadcast(). RTT from pong messages is cached in Redis
+    in batches by refresh() if rtt is set.
+    """
+    def __init__(self, jitter=0.0, tick=1.0, rtt=False):
+        self.loop = gevent.get_hub().loop
+        self.keepalives = {}  # fd: (keepalive, watcher)
+        self.timers = TimerWheel(tick)  # items of (fd, keepalive)
+        self.ready = set()  # fds with data to read
+        self.wakeup = gevent.event.Event()
+        self.keepalive_time = 60
+        self.jitter = jitter
+        self.serializer = Serializer()
+        self.bestblockhash = None
+        self.inv_msg = None  # inv message for bestblockhash
+        self.sampler = AddrSampler()
+        self.rtt = rtt
+        self.rtts = []  # (node, RTT in ms) not yet cached in Redis
+
+    def __len__(self):
+        return len(self.keepalives)
+
+    def refresh(self):
+        """
+        Sets keepalive interval to the duration of the last crawl,
+        refreshes the nodes sampled for addr messages and caches RTT values.
+        """
+        elapsed = REDIS_CONN.get('elapsed')
+        if elapsed is not None:
+            self.keepalive_time = int(elapsed)
+        self.sampler.refresh()
+        self.cache_rtt()
+
+    def cache_rtt(self):
+        """
+        Caches RTT values in Redis, see pcap.Cache.cache_rtt().
+        """
+        if len(self.rtts) == 0:
+            return
+        (rtts, self.rtts) = (self.rtts, [])
+        redis_pipe = REDIS_CONN.pipeline()
+        for (node, rtt) in rtts:
+            rtt_key = "rtt:{}-{}".format(node[0], node[1])
+            redis_pipe.lpush(rtt_key, rtt)
+            redis_pipe.ltrim(rtt_key, 0, SETTINGS['rtt_count'] - 1)
+            redis_pipe.expire(rtt_key, SETTINGS['ttl'])
+            if len(redis_pipe) >= REDIS_BATCH_SIZE:
+                redis_pipe.execute()
+        redis_pipe.execute()
+        logging.info("RTT: %d", len(rtts))
+
+    def schedule(self, fd, keepalive, start):
+        """
+        Schedules the next keepalive for the specified connection at one
+        interval, randomized by up to jitter of the interval, after start.
+        """
+        delay = self.keepalive_time * (
+            1 + random.uniform(-self.jitter, self.jitter))
+        self.timers.add(start + delay, (fd, keepalive))
+
+    def add(self, keepalive):
+        """
+        Starts watching the connection of the specified keepalive.
+        """
+        keepalive.open()
+        sock = keepalive.conn.socket
+        sock.settimeout(0.0)  # reads and writes must never block the worker
+        fd = sock.fileno()
+        watcher = self.loop.io(fd, 1)  # 1 = read
+        watcher.start(self.readable, fd)
+        self.keepalives[fd] = (keepalive, watcher)
+        self.schedule(fd, keepalive, keepalive.last_ping)
+        self.wakeup.set()
+        if self.inv_msg is not None:
+            try:
+                keepalive.send_bestblockhash(self.bestblockhash, self.inv_msg)
+            except socket.error as err:
+                self.remove(fd, err)
+
+    def remove(self, fd, err):
+        """
+        Stops watching and closes the connection for the specified fd.
+        """
+        (keepalive, watcher) = self.keepalives.pop(fd)
+        watcher.stop()
+        logging.debug("Closing %s (%s)", keepalive.node, err)
+        keepalive.close()
+
+    def broadcast(self, bestblockhash):
+        """
+        Sends an inv message for the specified consensus block to all
+        connections.
+        """
+        if bestblockhash == self.bestblockhash:
+            return
+        self.bestblockhash = bestblockhash
+        self.inv_msg = self.serializer.serialize_msg(
+            command="inv", inventory=[(2, bestblockhash)])
+        for (fd, (keepalive, _)) in self.keepalives.items():
+            try:
+                keepalive.send_bestblockhash(bestblockhash, self.inv_msg)
+            except socket.error as err:
+                self.remove(fd, err)
+                continue
+            STATUS['invs'] += 1
+        logging.info("Broadcasted %s to %d nodes", bestblockhash,
+                     len(self.keepalives))
+
+    def readable(self, fd):
+        # Called by the event loop, must not block
+        self.ready.add(fd)
+        self.wakeup.set()
+
+    def get_rtts(self, keepalive, msgs):
+        for msg in msgs:
+            if msg['command'] != "pong":
+                continue
+            rtt = keepalive.get_rtt(msg)
+            if rtt is not None:
+                self.rtts.append((keepalive.node, rtt))
+                STATUS['rtts'] += 1
+
+    def run(self):
+        """
+        Reads connections with data and keeps alive connections that are due
+        until the process is terminated.
+        """
+        while True:
+            timeout = None
+            if len(self.timers) > 0:
+                timeout = max(self.timers.next_tick() - time.time(), 0)
+            self.wakeup.wait(timeout)
+            self.wakeup.clear()
+
+            (ready, self.ready) = (self.ready, set())
+            for fd in ready:
+                if fd not in self.keepalives:
+                    continue
+                # Sink received messages to flush them off socket buffer
+                try:
+                    msgs = self.keepalives[fd][0].conn.recv_messages()
+                except (ProtocolError, ConnectionError, socket.error) as err:
+                    self.remove(fd, err)
+                    continue
+                STATUS['msgs'] += len(msgs)
+                if self.rtt:
+                    self.get_rtts(self.keepalives[fd][0], msgs)
+
+            now = time.time()
+            for (fd, keepalive) in self.timers.advance(now):
+                if self.keepalives.get(fd, (None,))[0] is not keepalive:
+                    continue  # closed, fd may have been reused
+                try:
+                    keepalive.keepalive(self.sampler)
+                except socket.error as err:
+                    self.remove(fd, err)
+                    continue
+                except redis.RedisError as err:
+                    logging.warning("%s: %s", keepalive.node, err)
+                self.schedule(fd, keepalive, now)
+
+
+def task(multiplexer):
     """
     Assigned to a worker to retrieve (pop) a node from the reachable set and
-    attempt to establish and maintain connection with the node.
+    attempt to establish connection with the node. Connection is then kept
+    alive by the multiplexer.
     """
     node = REDIS_CONN.spop('reachable')
     if node is None:
         return
-    (address, port, services, height) = eval(node)
+    (address, port, services, height) = REACHABLE_NODE.decode(node)
     node = (address, port)
 
-    if REDIS_CONN.sadd('open', node) == 0:
+    # Writes to open are not queued so that the SADD here is never applied
+    # before a queued SREM of a previous connection with the same node
+    if REDIS_CONN.sadd('open', OPEN_ADDR.encode(node)) == 0:
         logging.debug("Connection exists: %s", node)
         return
 
+    decode_commands = ["version"]
+    if SETTINGS['rtt']:
+        decode_commands.append("pong")
+
     handshake_msgs = []
     conn = Connection(node, (SETTINGS['source_address'], 0),
                       socket_timeout=SETTINGS['socket_timeout'],
@@ -191,7 +587,8 @@ def task():
                       from_services=SETTINGS['services'],
                       user_agent=SETTINGS['user_agent'],
                       height=height,
-                      relay=SETTINGS['relay'])
+                      relay=SETTINGS['relay'],
+                      decode_commands=decode_commands)
     try:
         conn.open()
         handshake_msgs = conn.handshake()
@@ -200,15 +597,13 @@ def task():
         conn.close()
 
     if len(handshake_msgs) == 0:
-        REDIS_CONN.srem('open', node)
+        REDIS_CONN.srem('open', OPEN_ADDR.encode(node))
         return
 
-    Keepalive(conn=conn, version_msg=handshake_msgs[0]).keepalive()
-    conn.close()
-    REDIS_CONN.srem('open', node)
+    multiplexer.add(Keepalive(conn=conn, version_msg=handshake_msgs[0]))
 
 
-def cron(pool):
+def cron(pool, multiplexer):
     """
     Assigned to a worker to perform the following tasks periodically to
     maintain a continuous network-wide connections:
@@ -217,10 +612,11 @@ def cron(pool):
     1) Checks for a new snapshot
     2) Loads new reachable nodes into the reachable set in Redis
     3) Signals listener to get reachable nodes from opendata set
-    4) Sets bestblockhash in Redis
+    4) Sets bestblockhash in Redis and publishes it to all processes
 
     [Master/Slave]
-    1) Spawns workers to establish and maintain connection with reachable nodes
+    1) Spawns workers to establish connection with reachable nodes for up to
+       the configured number of connections including open connections
     """
     snapshot = None
 
@@ -250,15 +646,41 @@ def cron(pool):
 
             set_bestblockhash()
 
-        for _ in xrange(min(REDIS_CONN.scard('reachable'), pool.free_count())):
-            pool.spawn(task)
+        free_count = pool.free_count() - len(multiplexer)
+        for _ in xrange(min(REDIS_CONN.scard('reachable'), free_count)):
+            pool.spawn(task, multiplexer)
 
         workers = SETTINGS['workers'] - pool.free_count()
         logging.info("Workers: %d", workers)
+        logging.info("Open: %d", len(multiplexer))
+
+        multiplexer.refresh()
 
         gevent.sleep(SETTINGS['cron_delay'])
 
 
+def broadcast(multiplexer):
+    """
+    Assigned to a worker to broadcast the consensus block to all connections
+    in this process as soon as it is set in Redis by the master process.
+    """
+    while True:
+        try:
+            pubsub = REDIS_CONN.pubsub()
+            pubsub.subscribe('bestblockhash')
+            # Consensus block set before subscribing
+            bestblockhash = REDIS_CONN.get('bestblockhash')
+            if bestblockhash is not None:
+                multiplexer.broadcast(bestblockhash)
+            for msg in pubsub.listen():
+                # 'bestblockhash' message is published by set_bestblockhash()
+                if msg['type'] == "message":
+                    multiplexer.broadcast(msg['data'])
+        except redis.RedisError as err:
+            logging.warning("Broadcast: %s", err)
+            gevent.sleep(SETTINGS['cron_delay'])
+
+
 def get_snapshot():
     """
     Returns latest JSON file (based on creation date) containing a snapshot of
@@ -274,12 +696,11 @@ def get_snapshot():
 
 def get_nodes(path):
     """
-    Returns all reachable nodes from a JSON file.
+    Returns all reachable nodes from a JSON file or from its binary sidecar.
     """
     nodes = []
-    text = open(path, 'r').read()
     try:
-        nodes = json.loads(text)
+        nodes = load_snapshot(path)
     except ValueError as err:
         logging.warning(err)
     return nodes
@@ -296,8 +717,10 @@ def set_reachable(nodes):
         port = node[1]
         services = node[2]
         height = node[3]
-        if not REDIS_CONN.sismember('open', (address, port)):
-            REDIS_CONN.sadd('reachable', (address, port, services, height))
+        member = OPEN_ADDR.encode((address, port))
+        if not REDIS_CONN.sismember('open', member):
+            REDIS_CONN.sadd('reachable', REACHABLE_NODE.encode(
+                (address, port, services, height)))
     return REDIS_CONN.scard('reachable')
 
 
@@ -315,14 +738,15 @@ def set_bestblockhash():
         return
 
     try:
-        reachable_nodes = eval(REDIS_CONN.lindex("nodes", 0))[-1]
-    except TypeError:
+        reachable_nodes = decode_legacy(REDIS_CONN.lindex("nodes", 0))[-1]
+    except DecodeError:
         logging.warning("nodes missing")
         return
 
     nodes = REDIS_CONN.zcard('inv:2:{}'.format(lastblockhash))
     if nodes >= reachable_nodes / 2.0:
         REDIS_CONN.set('bestblockhash', lastblockhash)
+        REDIS_CONN.publish('bestblockhash', lastblockhash)
         logging.info("bestblockhash: %s", lastblockhash)
 
 
@@ -342,7 +766,13 @@ def init_settings(argv):
     SETTINGS['relay'] = conf.getint('ping', 'relay')
     SETTINGS['socket_timeout'] = conf.getint('ping', 'socket_timeout')
     SETTINGS['cron_delay'] = conf.getint('ping', 'cron_delay')
+    SETTINGS['redis_flush_interval'] = conf.getint('ping',
+                                                   'redis_flush_interval')
+    SETTINGS['redis_flush_size'] = conf.getint('ping', 'redis_flush_size')
     SETTINGS['ttl'] = conf.getint('ping', 'ttl')
+    SETTINGS['rtt'] = conf.getboolean('ping', 'rtt')
+    SETTINGS['rtt_count'] = conf.getint('ping', 'rtt_count')
+    SETTINGS['keepalive_jitter'] = conf.getfloat('ping', 'keepalive_jitter')
     SETTINGS['crawl_dir'] = conf.get('ping', 'crawl_dir')
     if not os.path.exists(SETTINGS['crawl_dir']):
         os.makedirs(SETTINGS['crawl_dir'])
@@ -352,8 +782,9 @@ def init_settings(argv):
 
 
 def main(argv):
+    (argv, processes) = get_processes(argv)
     if len(argv) < 3 or not os.path.exists(argv[1]):
-        print("Usage: ping.py [config] [master|slave]")
+        print("Usage: ping.py [config] [master|slave] [--processes N]")
         return 1
 
     # Initialize global settings
@@ -373,15 +804,33 @@ def main(argv):
     print("Writing output to {}, press CTRL+C to terminate..".format(
         SETTINGS['logfile']))
 
-    if SETTINGS['master']:
+    # Fork worker processes with the first worker as master if set
+    restarted = False
+    if processes > 0:
+        supervisor = Supervisor(processes, SETTINGS['cron_delay'])
+        worker = supervisor.run()
+        if worker is None:
+            return 0
+        SETTINGS['master'] = SETTINGS['master'] and worker == 0
+        restarted = supervisor.restarted
+        gevent.spawn(report_status, SETTINGS['cron_delay'])
+
+    # Keys are kept for the other workers if master is restarted
+    if SETTINGS['master'] and not restarted:
         logging.info("Removing all keys")
         REDIS_CONN.delete('reachable')
         REDIS_CONN.delete('open')
         REDIS_CONN.delete('opendata')
 
-    # Initialize a pool of workers (greenlets)
+    # Initialize a pool of workers (greenlets) and the multiplexer which
+    # keeps alive the connections established by the workers
+    multiplexer = Multiplexer(jitter=SETTINGS['keepalive_jitter'],
+                              rtt=SETTINGS['rtt'])
+    gevent.spawn(multiplexer.run)
+    gevent.spawn(REDIS_QUEUE.run)
+    gevent.spawn(broadcast, multiplexer)
     pool = gevent.pool.Pool(SETTINGS['workers'])
-    pool.spawn(cron, pool)
+    pool.spawn(cron, pool, multiplexer)
     pool.join()
 
     return 0
@@ -112,8 +112,10 @@ Reference: https://en.bitcoin.it/wiki/Protocol_specification
 """
 
 import binascii
+import errno
 import gevent
 import hashlib
+import logging
 import random
 import socket
 import socks
@@ -134,10 +136,23 @@ RELAY = 0  # set to 1 to receive all txs
 DEFAULT_PORT = 8333
 
 SOCKET_BUFSIZE = 8192
+MAX_BUFSIZE = SOCKET_BUFSIZE * 8  # shrink idle receive buffer beyond this
 SOCKET_TIMEOUT = 15
 HEADER_LEN = 24
+MAX_PAYLOAD_LEN = 32 * 1024 * 1024  # MAX_SIZE in Bitcoin Core
+HEADER = struct.Struct("<4s12sI4s")
+
+# Serialized messages from cached_msg() keyed by (command, payload) for reuse
+# across connections
+MSG_CACHE = {}
+MSG_CACHE_SIZE = 1024
+
+# TIMESTAMP + SERVICES + IP_ADDR + PORT (big-endian, unpacked as 2 bytes)
+NETWORK_ADDRESS = struct.Struct("<IQ16sBB")
 
 ONION_PREFIX = "\xFD\x87\xD8\x7E\xEB\x43"  # ipv6 prefix for .onion address
+IPV4_PREFIX = "\x00" * 10 + "\xFF" * 2  # ipv6 prefix for ipv4-mapped address
+IPV4_COMPAT_PREFIX = "\x00" * 12  # ipv6 prefix for ipv4-compatible address
 
 
 class ProtocolError(Exception):
@@ -172,6 +187,10 @@ class ReadError(ProtocolError):
     pass
 
 
+class PayloadTooLargeError(ProtocolError):
+    pass
+
+
 class ProxyRequired(ConnectionError):
     pass
 
@@ -212,6 +231,140 @@ def create_connection(address, timeout=SOCKET_TIMEOUT, source_address=None,
                                     source_address=source_address)
 
 
+class Record(object):
+    """
+    Base class for compact records decoded from message payloads. Fields are
+    also accessible as dict items for callers expecting the dict form.
+    """
+    __slots__ = ()
+    KEYS = ()
+
+    def __getitem__(self, key):
+        if key not in self.KEYS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __contains__(self, key):
+        return key in self.KEYS
+
+    def __eq__(self, other):
+        if isinstance(other, Record):
+            other = dict(other.items())
+        return dict(self.items()) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    def get(self, key, default=None):
+        if key not in self.KEYS:
+            return default
+        return getattr(self, key)
+
+    def keys(self):
+        return list(self.KEYS)
+
+    def items(self):
+        return [(key, getattr(self, key)) for key in self.KEYS]
+
+
+class NetAddr(Record):
+    """
+    Network address with the raw 16-byte IP address from the payload.
+    """
+    __slots__ = ('timestamp', 'services', 'raw_ip', 'port')
+    KEYS = ('timestamp', 'services', 'ipv4', 'ipv6', 'onion', 'port')
+
+    def __init__(self, timestamp, services, raw_ip, port):
+        self.timestamp = timestamp
+        self.services = services
+        self.raw_ip = raw_ip
+        self.port = port
+
+    def is_onion(self):
+        return self.raw_ip[:6] == ONION_PREFIX
+
+    def is_ipv4(self):
+        # Matches the ipv4 suffix that inet_ntop() renders in dotted-quad
+        # notation for ipv4-mapped and ipv4-compatible ipv6 addresses.
+        prefix = self.raw_ip[:12]
+        if prefix == IPV4_PREFIX:
+            return True
+        return (prefix == IPV4_COMPAT_PREFIX and
+                self.raw_ip[12:14] != "\x00\x00")
+
+    @property
+    def ipv4(self):
+        if self.is_ipv4():
+            return socket.inet_ntop(socket.AF_INET, self.raw_ip[12:])
+        return ""
+
+    @property
+    def ipv6(self):
+        if self.is_onion() or self.is_ipv4():
+            return ""
+        return socket.inet_ntop(socket.AF_INET6, self.raw_ip)
+
+    @property
+    def onion(self):
+        if self.is_onion():
+            return b32encode(self.raw_ip[6:]).lower() + ".onion"
+        return ""
+
+
+class InvItem(Record):
+    """
+    Inventory item with the raw 32-byte hash from the payload.
+    """
+    __slots__ = ('type', 'raw_hash')
+    KEYS = ('type', 'hash')
+
+    def __init__(self, inv_type, raw_hash):
+        self.type = inv_type
+        self.raw_hash = raw_hash
+
+    @property
+    def hash(self):
+        return binascii.hexlify(self.raw_hash[::-1])  # BE -> LE
+
+
+class TxIn(Record):
+    """
+    Tx input with the raw 32-byte previous output hash from the payload.
+    """
+    __slots__ = ('raw_prev_out_hash', 'prev_out_index', 'script_length',
+                 'script', 'sequence')
+    KEYS = ('prev_out_hash', 'prev_out_index', 'script_length', 'script',
+            'sequence')
+
+    def __init__(self, raw_prev_out_hash, prev_out_index, script_length,
+                 script, sequence):
+        self.raw_prev_out_hash = raw_prev_out_hash
+        self.prev_out_index = prev_out_index
+        self.script_length = script_length
+        self.script = script
+        self.sequence = sequence
+
+    @property
+    def prev_out_hash(self):
+        return binascii.hexlify(self.raw_prev_out_hash[::-1])  # BE -> LE
+
+
+class TxOut(Record):
+    """
+    Tx output.
+    """
+    __slots__ = ('value', 'script_length', 'script')
+    KEYS = ('value', 'script_length', 'script')
+
+    def __init__(self, value, script_length, script):
+        self.value = value
+        self.script_length = script_length
+        self.script = script
+
+
 class Serializer(object):
     def __init__(self, **config):
         self.protocol_version = config.get('protocol_version',
@@ -223,16 +376,35 @@ class Serializer(object):
         if self.height is None:
             self.height = HEIGHT
         self.relay = config.get('relay', RELAY)
+        # Set of commands to decode payload for; payload for other commands is
+        # left as raw bytes in msg['payload'] for deserialize_payload().
+        self.decode_commands = config.get('decode_commands', None)
+        if self.decode_commands is not None:
+            self.decode_commands = set(self.decode_commands)
         # This is set prior to throwing PayloadTooShortError exception to
         # allow caller to fetch more data over the network.
         self.required_len = 0
 
     def serialize_msg(self, **kwargs):
         command = kwargs['command']
-        msg = [
-            MAGIC_NUMBER,
-            command + "\x00" * (12 - len(command)),
-        ]
+        return self.frame_msg(command, self.serialize_payload(**kwargs))
+
+    def cached_msg(self, **kwargs):
+        # Same as serialize_msg() for messages sent unchanged to many nodes,
+        # e.g. verack and getaddr, whose serialized bytes are reused across
+        # connections. Messages with per-node payload must not be cached.
+        command = kwargs['command']
+        key = (command, self.serialize_payload(**kwargs))
+        msg = MSG_CACHE.get(key)
+        if msg is None:
+            if len(MSG_CACHE) >= MSG_CACHE_SIZE:
+                MSG_CACHE.clear()
+            msg = self.frame_msg(*key)
+            MSG_CACHE[key] = msg
+        return msg
+
+    def serialize_payload(self, **kwargs):
+        command = kwargs['command']
 
         payload = ""
         if command == "version":
@@ -248,68 +420,89 @@ class Serializer(object):
         elif command == "inv" or command == "getdata":
             inventory = kwargs['inventory']
             payload = self.serialize_inv_payload(inventory)
+        return payload
 
-        msg.extend([
-            struct.pack("<I", len(payload)),
-            sha256(sha256(payload))[:4],
-            payload,
-        ])
-
-        msg = ''.join(msg)
-        return msg
+    def frame_msg(self, command, payload):
+        header = HEADER.pack(MAGIC_NUMBER, command, len(payload),
+                             sha256(sha256(payload))[:4])
+        return header + payload
 
     def deserialize_msg(self, data):
+        (msg, offset) = self.deserialize_msg_from(data)
+        return (msg, data[offset:])
+
+    def deserialize_msg_from(self, data, offset=0, size=None):
+        # Deserializes the message that starts at offset in data and returns
+        # it with the offset of the next message; the remaining data is never
+        # copied so that a buffer with many messages is walked in one pass.
+        # Only the first size bytes of data are used if size is specified.
         msg = {}
 
-        data_len = len(data)
+        if size is None:
+            size = len(data)
+        data_len = size - offset
         if data_len < HEADER_LEN:
             raise HeaderTooShortError("got {} of {} bytes".format(
                 data_len, HEADER_LEN))
 
-        data = StringIO(data)
-        header = data.read(HEADER_LEN)
-        msg.update(self.deserialize_header(header))
+        msg.update(self.deserialize_header(data, offset))
 
         if (data_len - HEADER_LEN) < msg['length']:
             self.required_len = HEADER_LEN + msg['length']
             raise PayloadTooShortError("got {} of {} bytes".format(
                 data_len, HEADER_LEN + msg['length']))
 
-        payload = data.read(msg['length'])
+        start = offset + HEADER_LEN
+        end = start + msg['length']
+        payload = data[start:end]
+        if type(payload) is not str:
+            payload = str(payload)  # e.g. from Connection's receive buffer
         computed_checksum = sha256(sha256(payload))[:4]
         if computed_checksum != msg['checksum']:
             raise InvalidPayloadChecksum("{} != {}".format(
                 binascii.hexlify(computed_checksum),
                 binascii.hexlify(msg['checksum'])))
 
-        if msg['command'] == "version":
+        if (self.decode_commands is None or
+                msg['command'] in self.decode_commands):
+            msg.update(self.deserialize_payload(msg['command'], payload))
+        else:
+            msg['payload'] = payload
+
+        return (msg, end)
+
+    def deserialize_payload(self, command, payload):
+        msg = {}
+        if command == "version":
             msg.update(self.deserialize_version_payload(payload))
-        elif msg['command'] == "ping" or msg['command'] == "pong":
+        elif command == "ping" or command == "pong":
             msg.update(self.deserialize_ping_payload(payload))
-        elif msg['command'] == "addr":
+        elif command == "addr":
             msg.update(self.deserialize_addr_payload(payload))
-        elif msg['command'] == "inv":
+        elif command == "inv":
             msg.update(self.deserialize_inv_payload(payload))
-        elif msg['command'] == "tx":
+        elif command == "tx":
             msg.update(self.deserialize_tx_payload(payload))
-        elif msg['command'] == "block":
+        elif command == "block":
             msg.update(self.deserialize_block_payload(payload))
+        return msg
 
-        return (msg, data.read())
-
-    def deserialize_header(self, data):
+    def deserialize_header(self, data, offset=0):
         msg = {}
-        data = StringIO(data)
 
-        msg['magic_number'] = data.read(4)
+        (msg['magic_number'], command, msg['length'],
+         msg['checksum']) = HEADER.unpack_from(data, offset)
         if msg['magic_number'] != MAGIC_NUMBER:
             raise InvalidMagicNumberError("{} != {}".format(
                 binascii.hexlify(msg['magic_number']),
                 binascii.hexlify(MAGIC_NUMBER)))
 
-        msg['command'] = data.read(12).strip("\x00")
-        msg['length'] = struct.unpack("<I", data.read(4))[0]
-        msg['checksum'] = data.read(4)
+        msg['command'] = command.strip("\x00")
+
+        # Length is from the node, reject it before buffering the payload
+        if msg['length'] > MAX_PAYLOAD_LEN:
+            raise PayloadTooLargeError("{} > {} bytes".format(
+                msg['length'], MAX_PAYLOAD_LEN))
 
         return msg
 
@@ -382,14 +575,23 @@ class Serializer(object):
 
     def deserialize_addr_payload(self, data):
         msg = {}
+        payload = data
         data = StringIO(data)
 
         msg['count'] = self.deserialize_int(data)
-        msg['addr_list'] = []
-        for _ in xrange(msg['count']):
-            network_address = self.deserialize_network_address(
-                data, has_timestamp=True)
-            msg['addr_list'].append(network_address)
+
+        # Decode all network addresses in one pass over the payload
+        offset = data.tell()
+        size = NETWORK_ADDRESS.size
+        end = offset + msg['count'] * size
+        if len(payload) < end:
+            raise ReadError("got {} of {} bytes".format(len(payload), end))
+        unpack_from = NETWORK_ADDRESS.unpack_from
+        msg['addr_list'] = [
+            NetAddr(timestamp, services, raw_ip, (port_hi << 8) | port_lo)
+            for (timestamp, services, raw_ip, port_hi, port_lo) in (
+                unpack_from(payload, idx) for idx in xrange(offset, end, size))
+        ]
 
         return msg
 
@@ -432,10 +634,14 @@ class Serializer(object):
         payload = ''.join(payload)
         return payload
 
-    def deserialize_tx_payload(self, data):
+    def deserialize_tx_payload(self, data, payload=None):
+        # data is either the raw tx or a stream positioned at the start of the
+        # tx within payload, e.g. when called from deserialize_block_payload.
         msg = {}
         if type(data) is str:
+            payload = data
             data = StringIO(data)
+        start = data.tell()
 
         msg['version'] = struct.unpack("<I", data.read(4))[0]
 
@@ -453,9 +659,12 @@ class Serializer(object):
 
         msg['lock_time'] = struct.unpack("<I", data.read(4))[0]
 
-        # Calculate hash from the entire payload
-        payload = self.serialize_tx_payload(msg)
-        msg['tx_hash'] = binascii.hexlify(sha256(sha256(payload))[::-1])
+        # Calculate hash from the raw bytes of the tx without copying them
+        if payload is not None:
+            raw_tx = memoryview(payload)[start:data.tell()]
+        else:
+            raw_tx = self.serialize_tx_payload(msg)
+        msg['tx_hash'] = binascii.hexlify(sha256(sha256(raw_tx))[::-1])
 
         return msg
 
@@ -467,6 +676,7 @@ class Serializer(object):
         # nonce (4 bytes) = 80 bytes
         msg['block_hash'] = binascii.hexlify(sha256(sha256(data[:80]))[::-1])
 
+        payload = data
         data = StringIO(data)
 
         msg['version'] = struct.unpack("<I", data.read(4))[0]
@@ -484,7 +694,7 @@ class Serializer(object):
         msg['tx_count'] = self.deserialize_int(data)
         msg['tx'] = []
         for _ in xrange(msg['tx_count']):
-            tx_payload = self.deserialize_tx_payload(data)
+            tx_payload = self.deserialize_tx_payload(data, payload=payload)
             msg['tx'].append(tx_payload)
 
         return msg
@@ -503,9 +713,8 @@ class Serializer(object):
                 ONION_PREFIX + b32decode(ip_address[:-6], True))
         elif "." in ip_address:
             # unused (12 bytes) + ipv4 (4 bytes) = ipv4-mapped ipv6 address
-            unused = "\x00" * 10 + "\xFF" * 2
             network_address.append(
-                unused + socket.inet_pton(socket.AF_INET, ip_address))
+                IPV4_PREFIX + socket.inet_pton(socket.AF_INET, ip_address))
         else:
             # ipv6 (16 bytes)
             network_address.append(
@@ -520,34 +729,10 @@ class Serializer(object):
             timestamp = unpack("<I", data.read(4))
 
         services = unpack("<Q", data.read(8))
-
-        _ipv6 = data.read(12)
-        _ipv4 = data.read(4)
+        raw_ip = data.read(16)
         port = unpack(">H", data.read(2))
-        _ipv6 += _ipv4
-
-        ipv4 = ""
-        ipv6 = ""
-        onion = ""
 
-        if _ipv6[:6] == ONION_PREFIX:
-            onion = b32encode(_ipv6[6:]).lower() + ".onion"  # use .onion
-        else:
-            ipv6 = socket.inet_ntop(socket.AF_INET6, _ipv6)
-            ipv4 = socket.inet_ntop(socket.AF_INET, _ipv4)
-            if ipv4 in ipv6:
-                ipv6 = ""  # use ipv4
-            else:
-                ipv4 = ""  # use ipv6
-
-        return {
-            'timestamp': timestamp,
-            'services': services,
-            'ipv4': ipv4,
-            'ipv6': ipv6,
-            'onion': onion,
-            'port': port,
-        }
+        return NetAddr(timestamp, services, raw_ip, port)
 
     def serialize_inventory(self, item):
         (inv_type, inv_hash) = item
@@ -560,15 +745,16 @@ class Serializer(object):
 
     def deserialize_inventory(self, data):
         inv_type = struct.unpack("<I", data.read(4))[0]
-        inv_hash = data.read(32)[::-1]  # BE -> LE
-        return {
-            'type': inv_type,
-            'hash': binascii.hexlify(inv_hash),
-        }
+        return InvItem(inv_type, data.read(32))
 
     def serialize_tx_in(self, tx_in):
+        if isinstance(tx_in, TxIn):
+            prev_out_hash = tx_in.raw_prev_out_hash
+        else:
+            prev_out_hash = binascii.unhexlify(
+                tx_in['prev_out_hash'])[::-1]  # LE -> BE
         payload = [
-            binascii.unhexlify(tx_in['prev_out_hash'])[::-1],  # LE -> BE
+            prev_out_hash,
             struct.pack("<I", tx_in['prev_out_index']),
             self.serialize_int(tx_in['script_length']),
             tx_in['script'],
@@ -578,18 +764,13 @@ class Serializer(object):
         return payload
 
     def deserialize_tx_in(self, data):
-        prev_out_hash = data.read(32)[::-1]  # BE -> LE
+        prev_out_hash = data.read(32)
         prev_out_index = struct.unpack("<I", data.read(4))[0]
         script_length = self.deserialize_int(data)
         script = data.read(script_length)
         sequence = struct.unpack("<I", data.read(4))[0]
-        return {
-            'prev_out_hash': binascii.hexlify(prev_out_hash),
-            'prev_out_index': prev_out_index,
-            'script_length': script_length,
-            'script': script,
-            'sequence': sequence,
-        }
+        return TxIn(prev_out_hash, prev_out_index, script_length, script,
+                    sequence)
 
     def serialize_tx_out(self, tx_out):
         payload = [
@@ -604,11 +785,7 @@ class Serializer(object):
         value = struct.unpack("<q", data.read(8))[0]
         script_length = self.deserialize_int(data)
         script = data.read(script_length)
-        return {
-            'value': value,
-            'script_length': script_length,
-            'script': script,
-        }
+        return TxOut(value, script_length, script)
 
     def serialize_string(self, data):
         length = len(data)
@@ -651,10 +828,20 @@ class Connection(object):
         self.to_addr = to_addr
         self.from_addr = from_addr
         self.serializer = Serializer(**config)
+        if self.serializer.decode_commands is not None:
+            # Nonce from ping is required to respond with pong
+            self.serializer.decode_commands.add("ping")
         self.socket_timeout = config.get('socket_timeout', SOCKET_TIMEOUT)
         self.proxy = config.get('proxy', None)
         self.socket = None
 
+        # Receive buffer; unread data is kept in recv_buffer[start:end]
+        self.recv_buffer = bytearray(SOCKET_BUFSIZE)
+        self.recv_start = 0
+        self.recv_end = 0
+        self.bytes_received = 0
+        self.recv_time = None  # time of the last read, for RTT from pong
+
     def open(self):
         self.socket = create_connection(self.to_addr,
                                         timeout=self.socket_timeout,
@@ -691,24 +878,107 @@ class Connection(object):
                     "{} closed connection".format(self.to_addr))
         return data
 
+    def recv_into_buffer(self, length=0):
+        # Reads at least length bytes (or whatever is available if length is
+        # 0) from the socket into the free space after recv_buffer[end]. The
+        # buffer is grown as data arrives rather than for length up front.
+        while True:
+            self.reserve(SOCKET_BUFSIZE)
+            view = memoryview(self.recv_buffer)[self.recv_end:]
+            try:
+                nbytes = self.socket.recv_into(view)
+            finally:
+                del view  # release buffer so that it can be resized
+            if nbytes == 0:
+                raise RemoteHostClosedConnection(
+                    "{} closed connection".format(self.to_addr))
+            self.recv_end += nbytes
+            self.bytes_received += nbytes
+            self.recv_time = time.time()
+            length -= nbytes
+            if length <= 0:
+                break
+
+    def reserve(self, size):
+        # Ensures at least size bytes of free space after recv_buffer[end] by
+        # moving unread data to the front of the buffer and growing it.
+        if len(self.recv_buffer) - self.recv_end >= size:
+            return
+        unread = self.recv_end - self.recv_start
+        if self.recv_start > 0:
+            self.recv_buffer[:unread] = \
+                self.recv_buffer[self.recv_start:self.recv_end]
+            self.recv_start = 0
+            self.recv_end = unread
+        if len(self.recv_buffer) - unread < size:
+            self.recv_buffer.extend(
+                bytearray(max(size, len(self.recv_buffer))))
+
     def get_messages(self, length=0, commands=None):
         msgs = []
-        data = self.recv(length=length)
-        while len(data) > 0:
+        self.recv_into_buffer(length=length)
+        while self.recv_start < self.recv_end:
             gevent.sleep(0)
             try:
-                (msg, data) = self.serializer.deserialize_msg(data)
+                (msg, self.recv_start) = self.serializer.deserialize_msg_from(
+                    self.recv_buffer, self.recv_start, self.recv_end)
+            except HeaderTooShortError:
+                self.recv_into_buffer(
+                    length=HEADER_LEN - (self.recv_end - self.recv_start))
+                continue
             except PayloadTooShortError:
-                data += self.recv(
-                    length=self.serializer.required_len - len(data))
-                (msg, data) = self.serializer.deserialize_msg(data)
+                self.recv_into_buffer(
+                    length=self.serializer.required_len -
+                    (self.recv_end - self.recv_start))
+                continue
             if msg.get('command') == "ping":
                 self.pong(msg['nonce'])  # respond to ping immediately
+            elif msg.get('command') == "pong":
+                msg['received'] = self.recv_time
             msgs.append(msg)
+        self.recv_start = 0
+        self.recv_end = 0
+        if len(self.recv_buffer) > MAX_BUFSIZE:
+            self.recv_buffer = bytearray(SOCKET_BUFSIZE)
         if len(msgs) > 0 and commands:
             msgs[:] = [msg for msg in msgs if msg.get('command') in commands]
         return msgs
 
+    def recv_messages(self):
+        # Non-blocking counterpart of get_messages() for a socket with zero
+        # timeout that is known to be readable. Reads once and returns the
+        # complete messages while a partial message is kept in the buffer to
+        # be completed by a later read.
+        try:
+            self.recv_into_buffer()
+        except socket.error as err:
+            if err.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+            return []
+        return list(self.iter_messages())
+
+    def iter_messages(self):
+        # Yields the complete messages already in the buffer without reading
+        # from the socket; a trailing partial message stays in the buffer.
+        # Each message is consumed from the buffer before it is yielded so
+        # an error on a later message does not lose it.
+        while self.recv_start < self.recv_end:
+            try:
+                (msg, self.recv_start) = self.serializer.deserialize_msg_from(
+                    self.recv_buffer, self.recv_start, self.recv_end)
+            except (HeaderTooShortError, PayloadTooShortError):
+                break
+            if msg.get('command') == "ping":
+                self.pong(msg['nonce'])  # respond to ping immediately
+            elif msg.get('command') == "pong":
+                msg['received'] = self.recv_time
+            yield msg
+        if self.recv_start == self.recv_end:
+            self.recv_start = 0
+            self.recv_end = 0
+            if len(self.recv_buffer) > MAX_BUFSIZE:
+                self.recv_buffer = bytearray(SOCKET_BUFSIZE)
+
     def handshake(self):
         # [version] >>>
         msg = self.serializer.serialize_msg(
@@ -722,16 +992,88 @@ class Connection(object):
 
         return msgs
 
-    def getaddr(self):
+    def handshake_getaddr(self, timeout=None, max_addr=None, idle_timeout=0):
+        # Pipelines handshake and getaddr by sending verack and getaddr as soon
+        # as version is received, see recv_addr_msgs() for the read limits.
+        # [version] >>>
+        msg = self.serializer.serialize_msg(
+            command="version", to_addr=self.to_addr, from_addr=self.from_addr)
+        self.send(msg)
+
+        # <<< [version] [verack] [addr]..
+        (handshake_msgs, addr_msgs) = self.recv_addr_msgs(
+            timeout=timeout, max_addr=max_addr, idle_timeout=idle_timeout)
+
+        if len(handshake_msgs) > 0:
+            handshake_msgs[:] = sorted(
+                handshake_msgs, key=itemgetter('command'), reverse=True)
+
+        return (handshake_msgs, addr_msgs)
+
+    def getaddr(self, timeout=None, max_addr=None, idle_timeout=0):
         # [getaddr] >>>
-        msg = self.serializer.serialize_msg(command="getaddr")
+        msg = self.serializer.cached_msg(command="getaddr")
         self.send(msg)
 
         # <<< [addr]..
-        msgs = self.get_messages(commands=["addr"])
+        if timeout is None:
+            msgs = self.get_messages(commands=["addr"])
+        else:
+            msgs = self.recv_addr_msgs(timeout=timeout, max_addr=max_addr,
+                                       idle_timeout=idle_timeout)[1]
 
         return msgs
 
+    def recv_addr_msgs(self, timeout=None, max_addr=None, idle_timeout=0):
+        # Reads messages until one of the following is reached:
+        # 1) timeout (in seconds) has elapsed
+        # 2) max_addr addresses have been received
+        # 3) no message is received for idle_timeout (in seconds) after the
+        #    first addr message, i.e. 0 stops right after the first addr
+        # Sends verack and getaddr on receiving version from the node.
+        if timeout is None:
+            timeout = self.socket_timeout
+        deadline = time.time() + timeout
+        handshake_msgs = []
+        addr_msgs = []
+        addr_count = 0
+
+        try:
+            while max_addr is None or addr_count < max_addr:
+                remaining = deadline - time.time()
+                if len(addr_msgs) > 0:
+                    remaining = min(remaining, idle_timeout)
+                if remaining <= 0:
+                    break
+                self.socket.settimeout(remaining)
+                # Reads once; a partial message stays buffered across reads
+                # so a timeout never discards the messages parsed so far
+                self.recv_into_buffer()
+                for msg in self.iter_messages():
+                    command = msg.get('command')
+                    if command == "version":
+                        # [verack] [getaddr] >>>
+                        self.send(
+                            self.serializer.cached_msg(command="verack") +
+                            self.serializer.cached_msg(command="getaddr"))
+                    if command == "version" or command == "verack":
+                        handshake_msgs.append(msg)
+                    elif command == "addr":
+                        addr_msgs.append(msg)
+                        addr_count += msg['count']
+        except socket.timeout:
+            pass
+        except (ProtocolError, ConnectionError, socket.error) as err:
+            # Keep the completed handshake and the addr messages received
+            # before the error
+            if len(handshake_msgs) == 0 and len(addr_msgs) == 0:
+                raise
+            logging.debug("%s: %s", self.to_addr, err)
+        finally:
+            self.socket.settimeout(self.socket_timeout)
+
+        return (handshake_msgs, addr_msgs)
+
     def addr(self, addr_list):
         # addr_list = [(TIMESTAMP, SERVICES, "IP_ADDRESS", PORT),]
         # [addr] >>>
@@ -45,6 +45,8 @@ from collections import defaultdict
 from ConfigParser import ConfigParser
 from decimal import Decimal
 
+from codec import GEOIP, OPEN_NODE
+
 redis.connection.socket = gevent.socket
 
 # Redis connection setup
@@ -116,7 +118,7 @@ class Resolve(object):
             if geoip[1] or geoip[5]:
                 resolved += 1  # country/asn is set
             key = 'resolve:{}'.format(address)
-            self.redis_pipe.hset(key, 'geoip', geoip)
+            self.redis_pipe.hset(key, 'geoip', GEOIP.encode(geoip))
             self.redis_pipe.expire(key, SETTINGS['ttl'])
             logging.debug("%s geoip: %s", key, geoip)
         logging.info("GeoIP: %d resolved", resolved)
@@ -253,7 +255,7 @@ def main(argv):
             logging.info("Timestamp: %d", timestamp)
             nodes = REDIS_CONN.smembers('opendata')
             logging.info("Nodes: %d", len(nodes))
-            addresses = set([eval(node)[0] for node in nodes])
+            addresses = set([OPEN_NODE.decode(node)[0] for node in nodes])
             resolve = Resolve(addresses=addresses)
             resolve.resolve_addresses()
             REDIS_CONN.publish('resolve', timestamp)
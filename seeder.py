@@ -29,7 +29,6 @@ Exports reachable nodes into a DNS zone file for DNS seeder.
 """
 
 import glob
-import json
 import logging
 import operator
 import os
@@ -42,6 +41,7 @@ from ConfigParser import ConfigParser
 from ipaddress import ip_address, ip_network
 
 from protocol import DEFAULT_PORT
+from snapshot import load as load_snapshot
 
 # Redis connection setup
 REDIS_SOCKET = os.environ.get('REDIS_SOCKET', "/tmp/redis.sock")
@@ -76,8 +76,7 @@ class Seeder(object):
             self.update_blocklist()
         if dump != self.dump:
             try:
-                self.nodes = json.loads(open(dump, "r").read(),
-                                        encoding="latin-1")
+                self.nodes = load_snapshot(dump, encoding="latin-1")
             except ValueError:
                 logging.warning("Write pending")
                 return
@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# snapshot.py - Streaming writer and loader for snapshots of nodes.
+#
+# Copyright (c) Addy Yeow Chin Heng <ayeowch@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Streaming writer and loader for snapshots of nodes.
+
+A snapshot is a JSON file with a list of rows. Rows are encoded into a
+temporary file as they are written and the file is renamed into place once
+complete so that readers never see a partially written snapshot.
+
+A snapshot may have a binary sidecar file with the same rows stored column
+by column in chunks of up to CHUNK_ROWS rows. Each numeric column is a
+packed array and each string column is an array of lengths followed by the
+concatenated UTF-8 strings, so that a column is decoded with a few calls
+instead of parsing every value.
+"""
+
+import json
+import os
+import struct
+import tempfile
+
+SIDECAR_MAGIC = "BNSNAP2\n"
+SIDECAR_EXT = ".bin"
+
+# Max. rows held in memory for each chunk of the sidecar
+CHUNK_ROWS = 10000
+
+# Column types in addition to struct format characters for numeric columns
+STRING = "S"  # string or None
+NONE_LEN = -1  # length for None
+
+CHUNK_LEN = struct.Struct("<I")  # rows in chunk
+COLUMN_LEN = struct.Struct("<Q")
+
+
+def get_sidecar_path(path):
+    """
+    Returns path of the binary sidecar file for the specified snapshot.
+    """
+    return os.path.splitext(path)[0] + SIDECAR_EXT
+
+
+def get_mode():
+    """
+    Returns the default mode for new files with the current umask applied.
+    """
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+
+def open_tmp(path):
+    """
+    Returns path and file object of a new temporary file in the same
+    directory as the specified path.
+    """
+    (fd, tmp_path) = tempfile.mkstemp(
+        prefix=".", suffix=".tmp", dir=os.path.dirname(path) or ".")
+    os.fchmod(fd, get_mode())  # mkstemp creates file with mode 0600
+    return (tmp_path, os.fdopen(fd, 'wb'))
+
+
+class Writer(object):
+    """
+    Writes rows into a snapshot at the specified path. A binary sidecar is
+    also written if fields is set to the column types of the rows, e.g.
+    "SHQi" for rows of address, port, services and height. Byte strings are
+    decoded with the specified encoding as in json.dumps().
+    """
+    def __init__(self, path, fields=None, encoding="utf-8"):
+        self.path = path
+        self.fields = fields
+        self.encoding = encoding
+        self.separator = ""
+        (self.tmp_path, self.file) = open_tmp(path)
+        self.file.write("[")
+        self.columns = None
+        self.sidecar = None
+        if self.fields is not None:
+            self.columns = [[] for _ in self.fields]
+            (self.sidecar_tmp_path, self.sidecar) = open_tmp(path)
+            self.sidecar.write(SIDECAR_MAGIC)
+            self.sidecar.write(json.dumps({'fields': self.fields}) + "\n")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, row):
+        self.file.write(self.separator + json.dumps(row,
+                                                    encoding=self.encoding))
+        self.separator = ", "
+        if self.columns is not None:
+            for (column, value) in zip(self.columns, row):
+                column.append(value)
+            if len(self.columns[0]) >= CHUNK_ROWS:
+                self.write_chunk()
+
+    def close(self):
+        """
+        Renames the complete snapshot and its sidecar into place. Sidecar is
+        renamed first to be available once the snapshot is found.
+        """
+        self.file.write("]")
+        self.file.close()
+        if self.sidecar is not None:
+            self.write_chunk()
+            self.sidecar.close()
+            os.rename(self.sidecar_tmp_path, get_sidecar_path(self.path))
+        os.rename(self.tmp_path, self.path)
+
+    def abort(self):
+        """
+        Removes the incomplete snapshot.
+        """
+        self.file.close()
+        os.remove(self.tmp_path)
+        if self.sidecar is not None:
+            self.sidecar.close()
+            os.remove(self.sidecar_tmp_path)
+
+    def write_chunk(self):
+        """
+        Writes the buffered rows into the sidecar as one chunk.
+        """
+        rows = len(self.columns[0])
+        if rows == 0:
+            return
+        self.sidecar.write(CHUNK_LEN.pack(rows))
+        for (field, column) in zip(self.fields, self.columns):
+            if field == STRING:
+                data = self.pack_strings(column)
+            else:
+                data = struct.pack("<{}{}".format(rows, field), *column)
+            self.sidecar.write(COLUMN_LEN.pack(len(data)))
+            self.sidecar.write(data)
+        self.columns = [[] for _ in self.fields]
+
+    def pack_strings(self, column):
+        lengths = []
+        strings = []
+        for value in column:
+            if value is None:
+                lengths.append(NONE_LEN)
+                continue
+            if not isinstance(value, unicode):
+                value = value.decode(self.encoding)
+            value = value.encode("utf-8")
+            lengths.append(len(value))
+            strings.append(value)
+        return (struct.pack("<{}i".format(len(lengths)), *lengths) +
+                "".join(strings))
+
+
+def load(path, encoding="utf-8"):
+    """
+    Returns rows as lists from the specified snapshot, or from its sidecar
+    if available. Strings are decoded into unicode in both cases.
+    """
+    sidecar_path = get_sidecar_path(path)
+    if os.path.exists(sidecar_path):
+        try:
+            return load_sidecar(sidecar_path)
+        except ValueError:
+            pass  # e.g. sidecar from a previous version
+    return json.loads(open(path, 'r').read(), encoding=encoding)
+
+
+def load_sidecar(path):
+    """
+    Returns rows as lists from the specified sidecar.
+    """
+    data = open(path, 'rb').read()
+    if not data.startswith(SIDECAR_MAGIC):
+        raise ValueError("{} is not a snapshot sidecar".format(path))
+    offset = data.index("\n", len(SIDECAR_MAGIC)) + 1
+    header = json.loads(data[len(SIDECAR_MAGIC):offset])
+
+    nodes = []
+    while offset < len(data):
+        try:
+            rows = CHUNK_LEN.unpack_from(data, offset)[0]
+        except struct.error as err:
+            raise ValueError("{}: {}".format(path, err))
+        offset += CHUNK_LEN.size
+        columns = []
+        for field in header['fields']:
+            try:
+                length = COLUMN_LEN.unpack_from(data, offset)[0]
+            except struct.error as err:
+                raise ValueError("{}: {}".format(path, err))
+            offset += COLUMN_LEN.size
+            column = data[offset:offset + length]
+            if len(column) != length:
+                raise ValueError("{} is truncated".format(path))
+            offset += length
+            try:
+                if field == STRING:
+                    columns.append(unpack_strings(column, rows))
+                else:
+                    columns.append(struct.unpack(
+                        "<{}{}".format(rows, field), column))
+            except struct.error as err:
+                raise ValueError("{}: {}".format(path, err))
+        nodes.extend(map(list, zip(*columns)))
+    return nodes
+
+
+def unpack_strings(data, rows):
+    """
+    Returns list of unicode strings from the specified string column.
+    """
+    lengths = struct.unpack_from("<{}i".format(rows), data)
+    strings = []
+    offset = 0
+    text = data[rows * 4:]
+    decoded = text.decode("utf-8")
+    if len(decoded) == len(text):
+        text = decoded  # ASCII only, byte offsets are character offsets
+        decoded = None
+    for length in lengths:
+        if length == NONE_LEN:
+            strings.append(None)
+            continue
+        value = text[offset:offset + length]
+        if decoded is not None:
+            value = value.decode("utf-8")
+        strings.append(value)
+        offset += length
+    return strings
@@ -1,12 +1,8 @@
 #!/bin/bash
-python -u crawl.py crawl.conf master > crawl.master.out 2>&1 &
-python -u crawl.py crawl.conf slave > crawl.slave.1.out 2>&1 &
+# Master runs as the first of the worker processes forked by --processes
+python -u crawl.py crawl.conf master --processes 2 > crawl.out 2>&1 &
 
-python -u ping.py ping.conf master > ping.master.out 2>&1 &
-python -u ping.py ping.conf slave > ping.slave.1.out 2>&1 &
-python -u ping.py ping.conf slave > ping.slave.2.out 2>&1 &
-python -u ping.py ping.conf slave > ping.slave.3.out 2>&1 &
-python -u ping.py ping.conf slave > ping.slave.4.out 2>&1 &
+python -u ping.py ping.conf master --processes 5 > ping.out 2>&1 &
 
 # export GEVENT_RESOLVER=ares (Recommended only on Linux!)
 python -u resolve.py resolve.conf > resolve.out 2>&1 &
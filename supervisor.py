@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# supervisor.py - Runs crawl.py or ping.py in multiple worker processes.
+#
+# Copyright (c) Addy Yeow Chin Heng <ayeowch@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Runs crawl.py or ping.py in multiple worker processes.
+
+Gevent runs all workers (greenlets) of a process on a single core. The
+supervisor forks the specified number of worker processes once settings are
+loaded, pins each worker to a CPU, restarts workers that exit and logs the
+throughput of all workers in one status line. Workers report their counters
+in STATUS to the supervisor through a pipe.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import json
+import logging
+import multiprocessing
+import os
+import select
+import signal
+import time
+from collections import Counter
+
+# Counters incremented by the worker, e.g. STATUS['nodes'] += 1
+STATUS = Counter()
+
+# Write end of the status pipe in a worker process
+STATUS_FD = None
+
+# Min. seconds between restarts of the same worker
+RESTART_DELAY = 5
+
+
+def get_processes(argv):
+    """
+    Returns the arguments without the --processes option and the number of
+    worker processes set by it, or 0 if the option is not set.
+    """
+    if "--processes" not in argv:
+        return (argv, 0)
+    idx = argv.index("--processes")
+    try:
+        processes = int(argv[idx + 1])
+    except (IndexError, ValueError):
+        processes = 0
+    return (argv[:idx] + argv[idx + 2:], processes)
+
+
+def set_cpu_affinity(cpu):
+    """
+    Pins the current process to the specified CPU. Returns False if CPU
+    affinity is not supported.
+    """
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, [cpu])
+        return True
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        sched_setaffinity = libc.sched_setaffinity
+    except (OSError, AttributeError):
+        return False
+    bits = ctypes.sizeof(ctypes.c_ulong) * 8
+    mask = (ctypes.c_ulong * (1024 // bits))()  # cpu_set_t
+    mask[cpu // bits] = 1 << (cpu % bits)
+    return sched_setaffinity(0, ctypes.sizeof(mask), mask) == 0
+
+
+def report_status(interval):
+    """
+    Writes the counters in STATUS to the supervisor every interval seconds.
+    Runs as a worker (greenlet) in a monkey-patched worker process.
+    """
+    while True:
+        time.sleep(interval)
+        line = json.dumps({'pid': os.getpid(), 'status': STATUS}) + "\n"
+        try:
+            os.write(STATUS_FD, line)  # atomic for up to PIPE_BUF bytes
+        except OSError as err:
+            logging.warning("Status: %s", err)
+            return
+
+
+class Supervisor(object):
+    """
+    Forks and supervises the specified number of worker processes and logs
+    their status every interval seconds.
+    """
+    def __init__(self, processes, interval):
+        self.processes = processes
+        self.interval = interval
+        self.cpus = multiprocessing.cpu_count()
+        self.worker = None  # worker index in a worker process
+        self.restarted = False  # True in a restarted worker process
+        self.workers = {}  # pid: worker index
+        self.started = {}  # worker index: start time
+        self.exited = set()  # worker indexes pending restart
+        self.restarts = 0
+        self.stopped = False
+        self.pid = os.getpid()
+        self.status = {}  # worker index: (time, last counters from worker)
+        self.rates = {}  # worker index: counters per second
+        (self.read_fd, self.write_fd) = os.pipe()
+        self.buf = ""  # partial status line from workers
+
+    def run(self):
+        """
+        Returns the worker index in a worker process. Returns None in the
+        supervisor process once it is terminated.
+        """
+        for idx in xrange(self.processes):
+            self.fork(idx)
+            if self.worker is not None:
+                return self.worker
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        while self.worker is None and not self.stopped:
+            self.supervise()
+        if self.worker is not None:
+            return self.worker  # restarted worker
+        self.terminate()
+        return None
+
+    def stop(self, signum, frame):
+        # Signal handler, workers are terminated once supervise() returns
+        if os.getpid() != self.pid:
+            os._exit(1)  # worker signalled before its handlers are reset
+        self.stopped = True
+
+    def fork(self, idx, restarted=False):
+        """
+        Forks a worker process with the specified index. Restarted is set for
+        a worker that replaces an exited worker.
+        """
+        global STATUS_FD
+        self.started[idx] = time.time()
+        pid = os.fork()
+        if pid == 0:
+            self.worker = idx
+            self.restarted = restarted
+            os.close(self.read_fd)
+            STATUS_FD = self.write_fd
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            cpu = idx % self.cpus
+            if not set_cpu_affinity(cpu):
+                logging.warning("CPU affinity not supported")
+            logging.info("Worker %d %s on CPU %d", idx,
+                         "restarted" if restarted else "started", cpu)
+            return
+        self.workers[pid] = idx
+
+    def supervise(self):
+        """
+        Reads status from workers and restarts exited workers for one
+        interval before logging the status line.
+        """
+        start = time.time()
+        while time.time() - start < self.interval and not self.stopped:
+            try:
+                (readable, _, _) = select.select([self.read_fd], [], [], 1)
+            except select.error as err:
+                if err.args[0] != errno.EINTR:
+                    raise
+                continue
+            if readable:
+                self.buf += os.read(self.read_fd, 65536)
+                lines = self.buf.split("\n")
+                self.buf = lines.pop()
+                for line in lines:
+                    self.update(json.loads(line))
+            if self.stopped:
+                return
+            self.reap()
+            if self.worker is not None:
+                return
+        self.log_status()
+
+    def reap(self):
+        """
+        Restarts exited workers, at most once every RESTART_DELAY seconds for
+        each worker.
+        """
+        for (pid, idx) in self.workers.items():
+            try:
+                (exited, status) = os.waitpid(pid, os.WNOHANG)
+            except OSError as err:
+                if err.errno != errno.ECHILD:
+                    raise
+                (exited, status) = (pid, 0)
+            if exited == 0:
+                continue
+            if os.WIFSIGNALED(status):
+                status = -os.WTERMSIG(status)
+            else:
+                status = os.WEXITSTATUS(status)
+            logging.warning("Worker %d (%d) exited with status %d", idx, pid,
+                            status)
+            del self.workers[pid]
+            self.status.pop(idx, None)
+            self.rates.pop(idx, None)
+            self.exited.add(idx)
+
+        for idx in sorted(self.exited):
+            if time.time() - self.started[idx] < RESTART_DELAY:
+                continue
+            self.exited.remove(idx)
+            self.restarts += 1
+            self.fork(idx, restarted=True)
+            if self.worker is not None:
+                return
+
+    def update(self, report):
+        """
+        Updates counters per second for a worker from its report.
+        """
+        idx = self.workers.get(report['pid'])
+        if idx is None:
+            return
+        now = time.time()
+        counters = report['status']
+        if idx in self.status:
+            (last, last_counters) = self.status[idx]
+            self.rates[idx] = dict([
+                (key, (value - last_counters.get(key, 0)) / (now - last))
+                for (key, value) in counters.items()])
+        self.status[idx] = (now, counters)
+
+    def log_status(self):
+        """
+        Logs one status line with the counters per second for all workers,
+        e.g. nodes: 812.3/s (201.1, 205.0, 203.2, 203.0)
+        """
+        keys = sorted(set([key for rates in self.rates.values()
+                           for key in rates]))
+        status = []
+        for key in keys:
+            rates = [self.rates.get(idx, {}).get(key, 0)
+                     for idx in xrange(self.processes)]
+            status.append("{}: {:.1f}/s ({})".format(
+                key, sum(rates),
+                ", ".join(["{:.1f}".format(rate) for rate in rates])))
+        logging.info("Processes: %d/%d, restarts: %d, %s", len(self.workers),
+                     self.processes, self.restarts, ", ".join(status))
+
+    def terminate(self):
+        """
+        Terminates all workers.
+        """
+        for pid in self.workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        for pid in self.workers:
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass